@@ -1,11 +1,23 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
 import math
+import os
+import pickle
+import queue
 import unicodedata
 import argparse
 import re
 import logging
 import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
+
+import profiling
+from flat_dict import MmapFlatDict, SharedFlatDict
+from metrics import DecoderMetrics
 
 
 # 英文标点转中文标点
@@ -115,50 +127,194 @@ def try_split_tosyllables(word, syllable_dict=SYLLABLES, max_len=7):
     syllables.reverse()
     return syllables
 
+# 标点: Unicode 标点类别(P*)的字符, 以及需要转换的英文标点
+def is_punct(char):
+    return unicodedata.category(char).startswith('P') or char in PUNCTUATION_MAP
+
+# 将字符集合压缩为正则字符类中的区间, 如 "!-#%-*"
+def get_char_ranges(chars):
+    codes = sorted(ord(c) for c in chars)
+    ranges = []
+    i = 0
+    while i < len(codes):
+        j = i
+        while j + 1 < len(codes) and codes[j + 1] == codes[j] + 1:
+            j += 1
+        ranges.append(re.escape(chr(codes[i])) if i == j else '%s-%s' % (re.escape(chr(codes[i])), re.escape(chr(codes[j]))))
+        i = j + 1
+    return ''.join(ranges)
+
+# 预先计算的基本多文种平面(BMP)的标点表, 编译为一个正则: 每个标点是一个 token, 其余按空白分割.
+# 辅助平面的字符不在表中, 含有它们的片段逐字符判断.
+kPunctTable = frozenset(chr(c) for c in range(0x10000) if not 0xD800 <= c < 0xE000 and is_punct(chr(c)))
+kPunctClass = get_char_ranges(kPunctTable)
+kTokenRegex = re.compile('([%s])|([^\\s%s]+)' % (kPunctClass, kPunctClass))
+kAstralRegex = re.compile('[\U00010000-\U0010FFFF]')
+
+# 逐个产生 (token, start, end): token 是拼音片段或转换后的标点, text[start:end] 是它在输入中的原文,
+# 用于将结果映射回输入
+def iter_tokens(text):
+    for m in kTokenRegex.finditer(text):
+        punct, token = m.groups()
+        if punct:
+            yield PUNCTUATION_MAP.get(punct, punct), m.start(), m.end()
+        elif token.isascii() or not kAstralRegex.search(token):
+            yield token, m.start(), m.end()
+        else:
+            yield from iter_astral_tokens(token, m.start())
+
+# 含辅助平面字符的片段: 逐字符区分标点
+def iter_astral_tokens(token, offset):
+    start = 0
+    for i, char in enumerate(token):
+        if is_punct(char):
+            if start < i:
+                yield token[start:i], offset + start, offset + i
+            yield PUNCTUATION_MAP.get(char, char), offset + i, offset + i + 1
+            start = i + 1
+    if start < len(token):
+        yield token[start:], offset + start, offset + len(token)
+
 # 分离标点和拼音
 def split_pinyin_and_punct(text):
-    tokens = []
-    current_token = ''
-    for char in text:
-        if unicodedata.category(char).startswith('P') or char in PUNCTUATION_MAP:
-            if current_token:
-                tokens.extend(current_token.strip().split())
-                current_token = ''
-            tokens.append(PUNCTUATION_MAP.get(char, char))
-        else:
-            current_token += char
-    if current_token:
-        tokens.extend(current_token.strip().split())
-    return tokens
+    with profiling.stage('tokenize'):
+        return _split_pinyin_and_punct(text)
+
+def _split_pinyin_and_punct(text):
+    if not text.isascii() and kAstralRegex.search(text):
+        return [token for token, start, end in iter_tokens(text)]
+    return [PUNCTUATION_MAP.get(punct, punct) if punct else token for punct, token in kTokenRegex.findall(text)]
+
+# 解析词典文本文件，格式：<pinyin>\t<word>\t<freq>
+def get_entries_from_text(lines):
+    for line in lines:
+        py, word, freq = line.strip().split('\t')
+        yield (py.lower(), word, int(freq))
+
+# 解析rime码表，格式：<word>\t<code>\t<freq>，返回 (word, code, freq)
+def get_rows_from_table(lines):
+    in_body = False
+    for line in lines:
+        if not in_body:
+            in_body = line.rstrip() == '...'
+            continue
+        parts = line.rstrip('\r\n').split('\t')
+        if len(parts) < 3 or not parts[0] or not parts[1].strip() or parts[0].startswith('#'):
+            continue
+        yield (parts[0], parts[1], int(parts[2]))
+
+# 解析rime码表，去掉编码中的空格，返回 (pinyin, word, freq)
+def get_entries_from_table(lines):
+    for word, code, freq in get_rows_from_table(lines):
+        yield (code.replace(' ', '').lower(), word.replace(' ', ''), freq)
+
+# 词典的表结构版本:
+#   1: rowid 表 dict, 以及索引 idx_pinyin, idx_word
+#   2: WITHOUT ROWID 表 dict, 覆盖索引 (pinyin, freq DESC), 以及每个拼音的最优词及其对数概率的汇总表 best
+SCHEMA_VERSION = 2
+
+# 缓存快照文件的格式版本, 见 DB.dump_cache_snapshot
+CACHE_SNAPSHOT_VERSION = 1
 
 class DB:
-    def __init__(self, path):
-        self.path = path
-        self.pinyin_to_words = defaultdict(list)
+    # metrics: an optional metrics.DecoderMetrics to observe the cache and the sql queries
+    # overlays: the (path, boost) of the overlay dictionaries, see attach_overlay
+    def __init__(self, path, metrics=None, overlays=()):
+        self.init_state(path, metrics)
         self.conn = sqlite3.connect(self.path)
         self.cursor = self.conn.cursor()
         self.init_db()
+        for overlay_path, boost in overlays:
+            self.attach_overlay(overlay_path, boost)
         logging.debug("Database initialized.")
 
+    # the state shared by all the connections of the dictionary, set up before connecting;
+    # cache: the mapping type of the word caches
+    def init_state(self, path, metrics, cache=dict):
+        self.path = path
+        self.pinyin_to_words = cache()
+        self.pinyin_to_best = cache()
+        self.total_freq = None
+        self.overlays = []  # [(alias, path, boost)] by priority, the last one first
+        self.overlay_count = 0
+        self.access_counts = None  # pinyin -> lookups, counted after track_access() for the cache snapshots
+        self.metrics = metrics
+        if metrics:
+            metrics.track_cache(self)
+
     def init_db(self):
         self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS dict (
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """)
+        self.cursor.execute("SELECT value FROM meta WHERE key = 'schema_version'")
+        row = self.cursor.fetchone()
+        self.cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'dict'")
+        if row:
+            self.schema_version = row[0]
+        elif self.cursor.fetchone()[0]:
+            self.schema_version = 1  # 旧词典, 可用 --migrate 升级
+        else:
+            self.create_tables()
+        self.conn.commit()
+
+    def create_tables(self):
+        self.cursor.execute("""
+            CREATE TABLE dict (
                 pinyin TEXT NOT NULL,
                 word TEXT NOT NULL,
                 freq INTEGER DEFAULT 0,
                 PRIMARY KEY (pinyin, word)
-            )
+            ) WITHOUT ROWID
         """)
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_pinyin ON dict(pinyin)")
-        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_word ON dict(word)")
-
+        # 按词频降序的覆盖索引, 同频时按词排序
+        self.cursor.execute("CREATE INDEX idx_pinyin_freq ON dict(pinyin, freq DESC)")
         self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS meta (
-                key TEXT PRIMARY KEY,
-                value INTEGER
-            )
+            CREATE TABLE best (
+                pinyin TEXT PRIMARY KEY,
+                word TEXT NOT NULL,
+                freq INTEGER,
+                logp REAL
+            ) WITHOUT ROWID
         """)
+        self.cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (SCHEMA_VERSION,))
+        self.schema_version = SCHEMA_VERSION
+
+    # 将旧版本的词典升级到 SCHEMA_VERSION, 重建汇总表并压缩数据库文件
+    def migrate(self):
+        if self.schema_version >= SCHEMA_VERSION:
+            return False
+        self.cursor.execute("ALTER TABLE dict RENAME TO dict_v1")
+        self.cursor.execute("DROP INDEX IF EXISTS idx_pinyin")
+        self.cursor.execute("DROP INDEX IF EXISTS idx_word")
+        self.create_tables()
+        self.cursor.execute("INSERT INTO dict (pinyin, word, freq) SELECT pinyin, word, freq FROM dict_v1")
+        self.cursor.execute("DROP TABLE dict_v1")
+        self.conn.commit()
+        self.update_best()
+        self.conn.execute("VACUUM")
+        logging.info(f"Migrated {self.path} to schema version {SCHEMA_VERSION}.")
+        return True
+
+    # 重新计算每个拼音的最优词及其对数概率 log((freq + 1) / total_freq)
+    def update_best(self):
+        if self.schema_version < 2:
+            return
+        total_freq = self.get_base_total_freq()
+        self.cursor.execute("DELETE FROM best")
+        rows = self.conn.execute("SELECT pinyin, word, freq FROM dict ORDER BY pinyin, freq DESC, word")
+        batch = []
+        last = None
+        for pinyin, word, freq in rows:
+            if pinyin == last:
+                continue
+            last = pinyin
+            batch.append((pinyin, word, freq, math.log((freq + 1) / total_freq)))
+        self.cursor.executemany("INSERT INTO best (pinyin, word, freq, logp) VALUES (?,?,?,?)", batch)
         self.conn.commit()
+        self.pinyin_to_best.clear()
 
     def update_meta(self, total_freq):
         self.cursor.execute("""
@@ -169,103 +325,561 @@ class DB:
 
     # 读取词典文本文件並寫入Db，格式：<pinyin>\t<word>\t<freq>
     def import_data(self, path):
-        entries = []
         with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                py, word, freq = line.strip().split('\t')
-                freq = int(freq)
-                entries.append((py.lower(), word, freq))
+            count = self.import_entries(get_entries_from_text(f))
+        logging.debug(f"Imported {count} entries into the database.")
 
+    # 直接读取rime码表(.dict.yaml)並寫入Db, 无需生成中间文本文件
+    def import_tables(self, paths):
+        count = 0
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                count += self.import_entries(get_entries_from_table(f))
+        logging.debug(f"Imported {count} entries from {len(paths)} tables into the database.")
+        return count
+
+    # 批量寫入 (pinyin, word, freq) 並更新总词频, entries 可以是任意迭代器
+    def import_entries(self, entries):
         BATCH_SIZE = 1000
-        for i in range(0, len(entries), BATCH_SIZE):
-            batch = entries[i:i + BATCH_SIZE]
-            placeholders = ','.join(['?'] * len(batch[0]))
-            sql = f"INSERT OR REPLACE INTO dict (pinyin, word, freq) VALUES ({placeholders})"
+        sql = "INSERT OR REPLACE INTO dict (pinyin, word, freq) VALUES (?,?,?)"
+        count = 0
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= BATCH_SIZE:
+                self.cursor.executemany(sql, batch)
+                count += len(batch)
+                batch = []
+        if batch:
             self.cursor.executemany(sql, batch)
+            count += len(batch)
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO meta (key, value) VALUES
+                ('version', COALESCE((SELECT value FROM meta WHERE key = 'version'), 0) + 1)
+        """)
         self.conn.commit()
 
         self.cursor.execute("SELECT SUM(freq + 1) FROM dict")
         total_freq = self.cursor.fetchone()[0]
         self.update_meta(total_freq)
-        logging.debug(f"Imported {len(entries)} entries into the database.")
+        self.update_best()
+        self.reset_cache()
+        return count
+
+    # 执行一条只读查询, 返回所有行
+    def query(self, sql, params=()):
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
+
+    # 在所有连接上执行一条语句, 如 ATTACH
+    def execute_all(self, sql, params=()):
+        self.conn.execute(sql, params)
+
+    # 叠加一个词典(convert_to_chinese.py 生成的数据库)作为覆盖层, 无需重新导入基础词典:
+    # 后叠加的层优先, 同一个(拼音, 词)取优先级最高的层的词频, 乘以该层的 boost
+    def attach_overlay(self, path, boost=1.0):
+        self.overlay_count += 1
+        alias = "overlay%d" % self.overlay_count
+        self.execute_all("ATTACH DATABASE ? AS %s" % alias, (path,))
+        self.overlays.append((alias, path, float(boost)))
+        self.reset_cache()
+        logging.debug(f"Attached the overlay {path} as {alias} with boost {boost}.")
+        return alias
+
+    def detach_overlay(self, alias):
+        self.overlays = [overlay for overlay in self.overlays if overlay[0] != alias]
+        self.execute_all("DETACH DATABASE %s" % alias)
+        self.reset_cache()
+
+    def reset_cache(self):
+        self.pinyin_to_words.clear()
+        self.pinyin_to_best.clear()
+        self.total_freq = None
+
+    # 合并各层的查询: 从各层选出满足 where 的行, 同一个(拼音, 词)只保留优先级最高的层,
+    # 按拼音, 词频降序, 词排序. where 可以引用 keys 等公共表
+    def get_layers_sql(self, where, base=True):
+        layers = []
+        if base:
+            layers.append("SELECT pinyin, word, freq, 0 AS layer FROM main.dict WHERE %s" % where)
+        for i, (alias, path, boost) in enumerate(self.overlays, 1):
+            layers.append("SELECT pinyin, word, CAST(freq * %r AS INTEGER) AS freq, %d AS layer FROM %s.dict WHERE %s" % (boost, i, alias, where))
+        # 与 MAX() 同时选出的列取自最大值所在的行
+        return ("SELECT pinyin, word, freq FROM (SELECT pinyin, word, freq, MAX(layer) FROM (%s) GROUP BY pinyin, word) "
+                "ORDER BY pinyin, freq DESC, word" % " UNION ALL ".join(layers))
 
+    # 各层合并后的 (pinyin, word, freq), 按拼音, 词频降序, 词排序
+    def iter_entries(self):
+        return iter(self.query(self.get_layers_sql("1")))
+
+    # 基础词典的总词频 SUM(freq + 1)
+    def get_base_total_freq(self):
+        return self.query("SELECT value FROM meta WHERE key = 'total_freq'")[0][0]
+
+    # 合并各层后的总词频: 基础词典的总词频, 加上覆盖层中的词的词频, 减去其在基础词典中的词频
     def get_total_freq(self):
-       self.cursor.execute("SELECT value FROM meta WHERE key = 'total_freq'")
-       total_freq = self.cursor.fetchone()[0]
-       return total_freq
+        if self.total_freq is None:
+            self.total_freq = self.get_base_total_freq()
+            if self.overlays:
+                sql = ("SELECT SUM(r.freq + 1) - COALESCE(SUM(d.freq + 1), 0) FROM (%s) r "
+                       "LEFT JOIN main.dict d ON d.pinyin = r.pinyin AND d.word = r.word" % self.get_layers_sql("1", base=False))
+                self.total_freq += self.query(sql)[0][0] or 0
+        return self.total_freq
+
+    # 最长的拼音的长度, 更长的拼音片段不会有匹配的词
+    def get_max_pinyin_len(self):
+        tables = ["main.dict"] + ["%s.dict" % alias for alias, path, boost in self.overlays]
+        return max(self.query("SELECT MAX(LENGTH(pinyin)) FROM %s" % table)[0][0] or 1 for table in tables)
+
+    # 词典版本, 每次导入递增, 用于区分缓存的解码结果; 包括各覆盖层及其 boost
+    def get_dict_version(self):
+        rows = self.query("SELECT value FROM meta WHERE key = 'version'")
+        version = "%d:%d" % (rows[0][0] if rows else 0, self.get_total_freq())
+        for alias, path, boost in self.overlays:
+            version += ":%s*%g" % (os.path.basename(path), boost)
+        return version
 
     # check cache self.pinyin_to_words at first, if not found, then query from sqlDB
     # and cache it
     def get_word_freq(self, pinyin):
+        if self.access_counts is not None:
+            self.access_counts[pinyin] += 1
         if pinyin in self.pinyin_to_words:
+            profiling.count('cache.hit')
+            if self.metrics:
+                self.metrics.word_freq_hits.inc()
             return self.pinyin_to_words[pinyin]
         else:
-            self.cursor.execute("SELECT word, freq FROM dict WHERE pinyin = ?", (pinyin,))
-            results = self.cursor.fetchall()
+            profiling.count('cache.miss')
+            profiling.count('sql.queries')
+            started = time.perf_counter()
+            with profiling.stage('sql'):
+                if self.overlays:
+                    results = [(word, freq) for py, word, freq in self.query(self.get_layers_sql("pinyin = ?1"), (pinyin,))]
+                else:
+                    results = self.query("SELECT word, freq FROM dict WHERE pinyin = ? ORDER BY freq DESC, word", (pinyin,))
+            if self.metrics:
+                self.metrics.word_freq_misses.inc()
+                self.metrics.sql_latency.observe(time.perf_counter() - started)
             if results:
-                for word, freq in results:
-                    self.pinyin_to_words[pinyin].append((word, freq))
-                return self.pinyin_to_words[pinyin]
-            else:
-                return []
+                self.pinyin_to_words[pinyin] = results
+            return results
+
+    # whether the best words are read from the summary table, which holds those of the base dictionary
+    def has_best_table(self):
+        return self.schema_version >= 2 and not self.overlays
+
+    # the (word, freq, logp) of the most frequent word of pinyin, ties going to the first word,
+    # read from the summary table and cached, or None
+    def get_best(self, pinyin):
+        if self.access_counts is not None:
+            self.access_counts[pinyin] += 1
+        if pinyin in self.pinyin_to_best:
+            profiling.count('cache.hit')
+            if self.metrics:
+                self.metrics.word_freq_hits.inc()
+            return self.pinyin_to_best[pinyin]
+        if not self.has_best_table():
+            word_freqs = self.get_word_freq(pinyin)
+            best = None
+            if word_freqs:
+                word, freq = max(word_freqs, key=lambda x: x[1])
+                best = (word, freq, math.log((freq + 1) / self.get_total_freq()))
+            self.pinyin_to_best[pinyin] = best
+            return best
+        profiling.count('cache.miss')
+        profiling.count('sql.queries')
+        started = time.perf_counter()
+        with profiling.stage('sql'):
+            rows = self.query("SELECT word, freq, logp FROM best WHERE pinyin = ?", (pinyin,))
+        row = rows[0] if rows else None
+        if self.metrics:
+            self.metrics.word_freq_misses.inc()
+            self.metrics.sql_latency.observe(time.perf_counter() - started)
+        self.pinyin_to_best[pinyin] = row
+        return row
 
-    # prefetch (word, freq) from sqlDB for a given list of pinyins in batch mode, and cache them
+    # prefetch from sqlDB for a given list of pinyins in batch mode, and cache them: the best words
+    # of the summary table, or (word, freq) of the dict table for databases of schema version 1,
+    # or of all the layers in one query when overlays are attached
     def prefetch_word_freq(self, pinyin_list):
         BATCH_SIZE = 1000
+        if self.has_best_table():
+            cache = self.pinyin_to_best
+            sql = "SELECT pinyin, word, freq, logp FROM best WHERE pinyin IN ({})"
+        elif self.overlays:
+            cache = self.pinyin_to_words
+            sql = "WITH keys(pinyin) AS (VALUES {}) " + self.get_layers_sql("pinyin IN keys").replace('{', '{{').replace('}', '}}')
+        else:
+            cache = self.pinyin_to_words
+            sql = "SELECT pinyin, word, freq FROM dict WHERE pinyin IN ({}) ORDER BY pinyin, freq DESC, word"
+        pinyin_list = list(dict.fromkeys(py.lower() for py in pinyin_list if py.lower() not in cache))
         for i in range(0, len(pinyin_list), BATCH_SIZE):
             batch = pinyin_list[i:i + BATCH_SIZE]
-            placeholders = ','.join(['?'] * len(batch))
-            sql = f"SELECT pinyin, word, freq FROM dict WHERE pinyin IN ({placeholders})"
-            self.cursor.execute(sql, batch)
-            results = self.cursor.fetchall()
-            for py, word, freq in results:
-                self.pinyin_to_words[py.lower()].append((word, freq))
+            placeholders = ','.join(['(?)' if self.overlays else '?'] * len(batch))
+            profiling.count('sql.queries')
+            started = time.perf_counter()
+            with profiling.stage('sql'):
+                results = self.query(sql.format(placeholders), batch)
+            if self.metrics:
+                self.metrics.prefetch_batch_size.observe(len(batch))
+                self.metrics.sql_latency.observe(time.perf_counter() - started)
+            if cache is self.pinyin_to_best:
+                for py in batch:
+                    cache[py] = None
+                for py, word, freq, logp in results:
+                    cache[py] = (word, freq, logp)
+            else:
+                word_freqs = defaultdict(list)
+                for py, word, freq in results:
+                    word_freqs[py].append((word, freq))
+                for py, words in word_freqs.items():
+                    cache[py] = words
         logging.debug(f"Prefetched {len(pinyin_list)} pinyin entries from the database.")
 
+    # 开始统计每个拼音的查询次数, 用于保存最常用的缓存条目
+    def track_access(self):
+        if self.access_counts is None:
+            self.access_counts = defaultdict(int)
+
+    # 将查询最多的 top_n 个拼音的缓存条目及其查询次数保存为快照, 与词典版本绑定, 返回保存的条目数
+    def dump_cache_snapshot(self, path, top_n=100000):
+        counts = self.access_counts or dict()
+        hottest = sorted(counts, key=lambda pinyin: (-counts[pinyin], pinyin))
+        best, words = [], []
+        for pinyin in hottest:
+            if len(best) + len(words) >= top_n:
+                break
+            if pinyin in self.pinyin_to_best:
+                best.append((pinyin, counts[pinyin], self.pinyin_to_best[pinyin]))
+            elif pinyin in self.pinyin_to_words:
+                words.append((pinyin, counts[pinyin], self.pinyin_to_words[pinyin]))
+        data = {"version": CACHE_SNAPSHOT_VERSION, "dict_version": self.get_dict_version(), "best": best, "words": words}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        logging.debug(f"Saved {len(best) + len(words)} cache entries into {path}.")
+        return len(best) + len(words)
+
+    # 启动时批量载入缓存快照, 快照属于其他版本的词典或无法读取时忽略, 返回载入的条目数
+    def load_cache_snapshot(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data["version"] != CACHE_SNAPSHOT_VERSION or data["dict_version"] != self.get_dict_version():
+                logging.info(f"Ignored the cache snapshot {path} of another dictionary version.")
+                return 0
+        except Exception as e:
+            logging.info(f"Ignored the cache snapshot {path}: {e}")
+            return 0
+        with profiling.stage('snapshot'):
+            for cache, entries in ((self.pinyin_to_best, data["best"]), (self.pinyin_to_words, data["words"])):
+                for pinyin, count, value in entries:
+                    cache[pinyin] = value
+                    if self.access_counts is not None:
+                        self.access_counts[pinyin] += count
+        count = len(data["best"]) + len(data["words"])
+        logging.debug(f"Loaded {count} cache entries from {path}.")
+        return count
+
     # 关闭数据库连接
     def close(self):
         self.cursor.close()
         self.conn.close()
         logging.debug("Database connection closed.")
 
+# 分段加锁的缓存: 键按哈希分到各段, 每段一把锁, 不同段的读写互不阻塞
+class StripedCache:
+    def __init__(self, stripes=16):
+        self.stripes = [dict() for _ in range(stripes)]
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def get_stripe(self, key):
+        return hash(key) % len(self.stripes)
+
+    def __contains__(self, key):
+        i = self.get_stripe(key)
+        with self.locks[i]:
+            return key in self.stripes[i]
+
+    def __getitem__(self, key):
+        i = self.get_stripe(key)
+        with self.locks[i]:
+            return self.stripes[i][key]
+
+    def __setitem__(self, key, value):
+        i = self.get_stripe(key)
+        with self.locks[i]:
+            self.stripes[i][key] = value
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    def clear(self):
+        for lock, stripe in zip(self.locks, self.stripes):
+            with lock:
+                stripe.clear()
+
+# 线程安全的只读词典: 连接池中的只读连接 (check_same_thread=False) 由各线程轮流借用,
+# 词频缓存是所有线程共享的分段加锁缓存. 一个进程中的多个线程共用一份词典, 不必各自打开.
+# 词典需是已存在的文件, 导入和升级仍用 DB.
+class ThreadSafeDB(DB):
+    def __init__(self, path, pool_size=4, metrics=None):
+        self.init_state(path, metrics, cache=StripedCache)
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(path))
+        self.pool_size = pool_size
+        self.connections = queue.Queue()
+        for _ in range(pool_size):
+            self.connections.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+        rows = self.query("SELECT value FROM meta WHERE key = 'schema_version'")
+        self.schema_version = rows[0][0] if rows else 1
+        self.get_total_freq()
+        logging.debug(f"Opened {path} with {pool_size} read-only connections.")
+
+    # 借用一个连接执行查询, 连接都被占用时等待
+    def query(self, sql, params=()):
+        conn = self.connections.get()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self.connections.put(conn)
+
+    # 借用所有的连接执行, 等待正在查询的线程归还
+    def execute_all(self, sql, params=()):
+        connections = [self.connections.get() for _ in range(self.pool_size)]
+        try:
+            for conn in connections:
+                conn.execute(sql, params)
+        finally:
+            for conn in connections:
+                self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+        logging.debug("Database connections closed.")
+
+# 解码结果缓存: 以 split_pinyin_and_punct 的 token 元组为键, 内存中按LRU淘汰,
+# 可选的磁盘层是一个sqlite文件, 以词典版本区分, 词典更新后旧结果不再命中
+class ResultCache:
+    FLUSH_SIZE = 1000
+
+    def __init__(self, capacity=10000, path=None, version=''):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.version = version
+        self.conn = None
+        self.pending = []
+        self.lock = threading.RLock()  # search_many 的各线程共用一个结果缓存
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    version TEXT NOT NULL,
+                    tokens TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    PRIMARY KEY (version, tokens)
+                ) WITHOUT ROWID
+            """)
+            self.conn.commit()
+
+    # 返回缓存的结果元组, 未命中时返回 None
+    def get(self, tokens):
+        with self.lock:
+            return self._get(tokens)
+
+    def _get(self, tokens):
+        result = self.entries.get(tokens)
+        if result is not None:
+            self.entries.move_to_end(tokens)
+            profiling.count('result_cache.hit')
+            return result
+        if self.conn:
+            row = self.conn.execute("SELECT result FROM results WHERE version = ? AND tokens = ?",
+                                    (self.version, json.dumps(tokens, ensure_ascii=False))).fetchone()
+            if row:
+                profiling.count('result_cache.hit')
+                result = tuple(json.loads(row[0]))
+                self.remember(tokens, result)
+                return result
+        profiling.count('result_cache.miss')
+        return None
+
+    def put(self, tokens, result):
+        result = tuple(result)
+        with self.lock:
+            self.remember(tokens, result)
+            if self.conn:
+                self.pending.append((self.version, json.dumps(tokens, ensure_ascii=False), json.dumps(result, ensure_ascii=False)))
+                if len(self.pending) >= self.FLUSH_SIZE:
+                    self.flush()
+
+    def remember(self, tokens, result):
+        if self.capacity <= 0:
+            return
+        self.entries[tokens] = result
+        self.entries.move_to_end(tokens)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        with self.lock:
+            if self.conn and self.pending:
+                self.conn.executemany("INSERT OR REPLACE INTO results (version, tokens, result) VALUES (?,?,?)", self.pending)
+                self.conn.commit()
+                self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+# 一次搜索的预算: 时间(秒)和/或工作量(词图中的词典查询次数), 用完后逐级降级:
+#   viterbi: 完整的 DAG-Viterbi 搜索, 未知拼音再做深度搜索
+#   greedy: 在已建好的部分词图上正向最大匹配, 词图之外的拼音原样输出;
+#           或深度搜索被预算跳过或中断, 其未知拼音原样输出
+#   passthrough: 词图为空, 原样输出拼音
+# 搜索结束后 tier 是给出结果的级别
+class Budget:
+    TIERS = ('viterbi', 'greedy', 'passthrough')
+
+    def __init__(self, seconds=None, work=None):
+        self.deadline = time.perf_counter() + seconds if seconds is not None else None
+        self.work = work
+        self.spent = 0
+        self.tier = 'viterbi'
+
+    def spend(self, n=1):
+        self.spent += n
+
+    def exhausted(self):
+        if self.work is not None and self.spent >= self.work:
+            return True
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def degrade(self, tier):
+        if self.TIERS.index(tier) > self.TIERS.index(self.tier):
+            self.tier = tier
+
+# 批量 Viterbi 的 max-plus 递推: lattices 是各行的 (拼音数, [(起点, 终点, 对数概率)]),
+# 打包成补齐的边权数组 scores[行, 位置, 跨度-1], 无边处为 -inf. 各行右端对齐, 都在位置 T 结束,
+# 于是从 T-1 到 0 每个位置只需一次对所有行的向量运算. 同分时取较长的词, 与 calc_route 中
+# max(candidates) 的元组比较一致. 返回各行的 route, 以位置为下标的 (对数概率, 终点) 列表,
+# 可以像 calc_route 的字典一样传给 decode_pinyin_path
+def calc_batch_routes(lattices):
+    import numpy as np
+    B = len(lattices)
+    lengths = np.array([n for n, _ in lattices], dtype=np.intp)
+    T = int(lengths.max(initial=0))
+    edges = np.array([x for _, line_edges in lattices for edge in line_edges for x in edge], dtype=np.float64).reshape(-1, 3)
+    rows = np.repeat(np.arange(B), [len(line_edges) for _, line_edges in lattices])
+    starts = edges[:, 0].astype(np.intp)
+    spans = edges[:, 1].astype(np.intp) - starts
+    K = int(spans.max(initial=1))
+    scores = np.full((B, T, K), -np.inf)
+    offsets = T - lengths
+    scores[rows, offsets[rows] + starts, spans - 1] = edges[:, 2]
+    best = np.full((B, T + K + 1), -np.inf)  # 位置 T 之后补齐 -inf, 使每个位置都能取 K 个终点
+    best[:, T] = 0.0
+    back = np.zeros((B, T), dtype=np.intp)
+    lines = np.arange(B)
+    for p in range(T - 1, -1, -1):
+        candidates = scores[:, p, :] + best[:, p + 1:p + 1 + K]
+        k = K - 1 - candidates[:, ::-1].argmax(axis=1)  # 反向取首个最大值, 即同分时最长的词
+        best[:, p] = candidates[lines, k]
+        back[:, p] = p + 1 + k
+    back -= offsets[:, None]  # 终点换回各行自己的位置
+    routes = []
+    for offset, line_best, line_back in zip(offsets.tolist(), best[:, :T].tolist(), back.tolist()):
+        routes.append(list(zip(line_best[offset:], line_back[offset:])) + [(0, 0)])
+    return routes
+
 class DAGViterbiSearcher:
-    def __init__(self, db):
+    # metrics: defaults to the metrics of db
+    # result_cache: an optional ResultCache of the lines searched
+    # budget_seconds, budget_work: the default Budget of each line, unlimited if both are None
+    def __init__(self, db, metrics=None, result_cache=None, budget_seconds=None, budget_work=None):
         self.db = db
-        self.total_freq = self.db.get_total_freq()
+        self.metrics = metrics if metrics is not None else getattr(db, 'metrics', None)
+        self.result_cache = result_cache
+        self.budget_seconds = budget_seconds
+        self.budget_work = budget_work
+
+    # 每行的默认预算, 没有限制时为 None
+    def new_budget(self):
+        if self.budget_seconds is None and self.budget_work is None:
+            return None
+        return Budget(self.budget_seconds, self.budget_work)
 
-    # 创建 DAG
-    def create_dag(self, pinyin_list):
+    # 创建 DAG, 预算用完时只建到当前位置之前, 即 len(dag) 个位置
+    def create_dag(self, pinyin_list, budget=None):
         N = len(pinyin_list)
         dag = defaultdict(list)
         for i in range(N):
+            if budget:
+                if budget.exhausted():
+                    break
+                budget.spend(N - i)
             for j in range(i + 1, N + 1):
                 seg = ''.join(p.lower() for p in pinyin_list[i:j])
-                word_freqs = self.db.get_word_freq(seg)
-                if word_freqs:
+                if self.db.get_best(seg):
                     dag[i].append(j)
             if not dag[i]:
                 dag[i].append(i + 1)  # 无匹配时，按单个拼音前进
         return dag
 
-    # Viterbi 计算最优路径
-    def calc_route(self, pinyin_list, dag):
+    # Viterbi 计算最优路径, 预算用完时返回 None
+    def calc_route(self, pinyin_list, dag, budget=None):
         N = len(pinyin_list)
         route = {N: (0, 0)}
         for i in range(N - 1, -1, -1):
+            if budget and budget.exhausted():
+                return None
             candidates = []
             for j in dag[i]:
-                seg = ''.join(p.lower() for p in pinyin_list[i:j])
-                word_freqs = self.db.get_word_freq(seg)
-                if word_freqs:
-                    prob = max(math.log((freq + 1) / self.total_freq) for word, freq in word_freqs)
-                else:
-                    prob = math.log(1 / self.total_freq) * (j - i) # 惩罚未知拼音组合
+                prob = self.calc_prob(pinyin_list, i, j)
                 candidates.append((prob + route[j][0], j))
             route[i] = max(candidates)
         return route
 
+    # 拼音片段 pinyin_list[i:j] 作为一个词的对数概率, 即其最优词预先计算的对数概率
+    def calc_prob(self, pinyin_list, i, j):
+        seg = ''.join(p.lower() for p in pinyin_list[i:j])
+        best = self.db.get_best(seg)
+        if best:
+            return best[2]
+        return math.log(1 / self.db.get_total_freq()) * (j - i) # 惩罚未知拼音组合
+
+    # 正向最大匹配: 在已建好的词图上每次取最长的词, 词图之外的拼音原样输出
+    def decode_greedy(self, pinyin_list, dag, budget):
+        N = len(pinyin_list)
+        built = len(dag)
+        budget.degrade('greedy' if built else 'passthrough')
+        result = []
+        idx = 0
+        while idx < N:
+            if idx >= built:
+                result.extend(pinyin_list[idx:])
+                break
+            if not pinyin_list[idx][0].isalpha():
+                result.append(pinyin_list[idx])
+                idx += 1
+                continue
+            next_idx = max(dag[idx])
+            best = self.db.get_best(''.join(p.lower() for p in pinyin_list[idx:next_idx]))
+            if best:
+                result.append(best[0])
+            else:
+                result.extend(pinyin_list[idx:next_idx])
+            idx = next_idx
+        return result
+
     # 回溯路径并生成汉字或原始拼音输出
-    def decode_pinyin_path(self, pinyin_list, route,  within_deepsearch=False):
+    def decode_pinyin_path(self, pinyin_list, route,  within_deepsearch=False, budget=None):
         N = len(pinyin_list)
         result = []
         idx = 0
@@ -277,21 +891,30 @@ class DAGViterbiSearcher:
                 continue
             next_idx = route[idx][1]
             word_pinyin_seg = ''.join(p.lower() for p in pinyin_list[idx:next_idx])
-            word_freqs = self.db.get_word_freq(word_pinyin_seg)
-            if word_freqs:
-                best_word = max(word_freqs, key=lambda x: x[1])[0]
-                result.append(best_word)
+            best = self.db.get_best(word_pinyin_seg)
+            if best:
+                result.append(best[0])
             else:
                 if within_deepsearch:
                     return []  # 深度搜索失败
+                if self.metrics:
+                    self.metrics.unknown_spans.inc()
                 unmatched_list = pinyin_list[idx:next_idx]
-                sub_result = self.search_onceagain_with_segment(unmatched_list)
-                result.extend(sub_result)
+                if budget and budget.exhausted():
+                    profiling.count('budget.deep_search_skipped')
+                    budget.degrade('greedy')
+                    result.extend(unmatched_list)
+                else:
+                    result.extend(self.search_onceagain_with_segment(unmatched_list, budget))
             idx = next_idx
         return result
 
     # 尝试分割未知拼音, 并且通过DAG—Viterbi算法检索最佳匹配, 如果成功返回结果, 否则返回原始拼音
-    def search_onceagain_with_segment(self, unmatched_list):
+    def search_onceagain_with_segment(self, unmatched_list, budget=None):
+        with profiling.stage('deep_search'):
+            return self._search_onceagain_with_segment(unmatched_list, budget)
+
+    def _search_onceagain_with_segment(self, unmatched_list, budget=None):
         pinyin_list = []
         for token in unmatched_list:
             syllables = try_split_tosyllables(token)
@@ -299,17 +922,198 @@ class DAGViterbiSearcher:
                 return unmatched_list # 无法分割
             pinyin_list.extend(syllables)
 
-        result = self.search(pinyin_list, within_deepsearch=True)
+        result = self.search(pinyin_list, within_deepsearch=True, budget=budget)
         # 如果在深度搜索中没有找到匹配的词，返回原始拼音
         return result if result else unmatched_list
 
-    # DAG Viterbi 搜索器
-    def search(self, pinyin_list, within_deepsearch=False):
-        dag = self.create_dag(pinyin_list)
-        route = self.calc_route(pinyin_list, dag)
-        result = self.decode_pinyin_path(pinyin_list, route, within_deepsearch)
+    # DAG Viterbi 搜索器, 顶层搜索先查结果缓存, 未命中时预取词频数据.
+    # budget: 本次搜索的 Budget, 默认为 new_budget(); 降级的结果不进入结果缓存
+    def search(self, pinyin_list, within_deepsearch=False, budget=None):
+        if within_deepsearch:
+            return self._search(pinyin_list, within_deepsearch, budget)
+        if budget is None:
+            budget = self.new_budget()
+        tokens = tuple(pinyin_list)
+        if self.result_cache:
+            result = self.result_cache.get(tokens)
+            if result is not None:
+                return list(result)
+        self.db.prefetch_word_freq(pinyin_list)
+        result = self._search(pinyin_list, within_deepsearch, budget)
+        if budget:
+            profiling.count('tier.' + budget.tier)
+            if self.metrics:
+                self.metrics.observe_tier(budget.tier)
+        if self.result_cache and (budget is None or budget.tier == 'viterbi'):
+            self.result_cache.put(tokens, result)
         return result
 
+    # 多线程解码多行, 返回格式化后的文本: 相同的行只解码一次, 其余按批分给线程池.
+    # 词典需可被多个线程读取, 即 ThreadSafeDB 或 FlatDict; 未给出 executor 时使用临时线程池
+    def search_many(self, lines, executor=None, batch_size=64):
+        unique = list(dict.fromkeys(lines))
+        batches = [unique[i:i + batch_size] for i in range(0, len(unique), batch_size)]
+        decode = lambda batch: [decode_line(line, self) for line in batch]
+        if executor is None:
+            with ThreadPoolExecutor() as executor:
+                results = list(executor.map(decode, batches))
+        else:
+            results = list(executor.map(decode, batches))
+        decoded = dict(zip(unique, (text for result in results for text in result)))
+        return [decoded[line] for line in lines]
+
+    # 一行的词图及其边权, 即 calc_batch_routes 的 (拼音数, [(起点, 终点, 对数概率)]).
+    # 与 create_dag 和 calc_prob 相同, 但词的拼音不长于 max_pinyin_len, 更长的片段不必查询
+    def get_lattice(self, pinyin_list, max_pinyin_len, penalty):
+        N = len(pinyin_list)
+        edges = []
+        for i in range(N):
+            found = False
+            seg = ''
+            for j in range(i + 1, N + 1):
+                seg += pinyin_list[j - 1].lower()
+                if len(seg) > max_pinyin_len:
+                    break
+                best = self.db.get_best(seg)
+                if best:
+                    edges.append((i, j, best[2]))
+                    found = True
+            if not found:
+                edges.append((i, i + 1, penalty))  # 无匹配时，按单个拼音前进
+        return N, edges
+
+    # 离线批量解码多行拼音列表: 按长度排序后每 batch_size 行一批, 由 calc_batch_routes
+    # 同时递推一批的所有行, 再逐行由 decode_pinyin_path 回溯, 结果与逐行 search 相同.
+    # 没有 numpy 或设置了预算时逐行 search
+    def search_batch(self, pinyin_lists, batch_size=256):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is None or self.new_budget() is not None:
+            return [self.search(pinyin_list) for pinyin_list in pinyin_lists]
+        results = [None] * len(pinyin_lists)
+        missing = []
+        for n, pinyin_list in enumerate(pinyin_lists):
+            if self.result_cache:
+                result = self.result_cache.get(tuple(pinyin_list))
+                if result is not None:
+                    results[n] = list(result)
+                    continue
+            missing.append(n)
+        if not missing:
+            return results
+        max_pinyin_len = self.db.get_max_pinyin_len()
+        penalty = math.log(1 / self.db.get_total_freq())
+        missing.sort(key=lambda n: len(pinyin_lists[n]))
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            with profiling.stage('dag'):
+                lattices = []
+                for n in batch:
+                    self.db.prefetch_word_freq(pinyin_lists[n])
+                    lattices.append(self.get_lattice(pinyin_lists[n], max_pinyin_len, penalty))
+            with profiling.stage('route'):
+                routes = calc_batch_routes(lattices)
+            with profiling.stage('decode'):
+                for n, route in zip(batch, routes):
+                    results[n] = self.decode_pinyin_path(pinyin_lists[n], route)
+                    if self.result_cache:
+                        self.result_cache.put(tuple(pinyin_lists[n]), results[n])
+        return results
+
+    def _search(self, pinyin_list, within_deepsearch, budget=None):
+        started = time.perf_counter()
+        with profiling.stage('dag'):
+            dag = self.create_dag(pinyin_list, budget)
+        route = None
+        if len(dag) == len(pinyin_list):
+            with profiling.stage('route'):
+                route = self.calc_route(pinyin_list, dag, budget)
+        if route is None:
+            if within_deepsearch:
+                budget.degrade('greedy')
+                return []  # 预算用完, 深度搜索失败, 由上层原样输出
+            with profiling.stage('greedy'):
+                result = self.decode_greedy(pinyin_list, dag, budget)
+        else:
+            with profiling.stage('decode'):
+                result = self.decode_pinyin_path(pinyin_list, route, within_deepsearch, budget)
+        if self.metrics and not within_deepsearch:
+            self.metrics.observe_line(len(pinyin_list), started)
+        return result
+
+# 逐键输入的增量解码会话: 保存前向Viterbi的格状态, 每追加一个拼音只计算结束于新位置的边.
+# 边的拼音不长于词典中最长的拼音, 所以每次至多查询 max_pinyin_len 次, 与句子长度无关.
+# 词图与 create_dag 相同: 起始于 i 的词都不在已输入的拼音之内时, 才有 i 到 i+1 的单个拼音边.
+# 新的词使这条边消失时, 只需重算其后窗口内的位置; 退格则丢弃最后一个位置及结束于它的词.
+#   best[k]: 前 k 个拼音的最优对数概率, back[k]: 最优路径中结束于 k 的词的起点
+#   ends[k]: 结束于 k 的词的 (起点, 对数概率), starts[i]: 起始于 i 且已输入完的词数
+class DecodingSession:
+    def __init__(self, searcher, max_pinyin_len=None):
+        self.searcher = searcher
+        self.max_pinyin_len = max_pinyin_len or searcher.db.get_max_pinyin_len()
+        self.pinyin_list = []
+        self.best = [0.0]
+        self.back = [0]
+        self.ends = [[]]
+        self.starts = []
+
+    def append(self, token):
+        self.pinyin_list.append(token)
+        k = len(self.pinyin_list)
+        self.starts.append(0)
+        edges = []
+        length = 0
+        for i in range(k - 1, -1, -1):
+            length += len(self.pinyin_list[i])
+            if length > self.max_pinyin_len:
+                break
+            if self.searcher.db.get_best(''.join(p.lower() for p in self.pinyin_list[i:k])):
+                edges.append((i, self.searcher.calc_prob(self.pinyin_list, i, k)))
+        self.ends.append(edges)
+        changed = k
+        for i, _ in edges:
+            if self.starts[i] == 0:
+                changed = min(changed, i + 1)  # i 到 i+1 的单个拼音边消失
+            self.starts[i] += 1
+        self.relax(changed)
+
+    def backspace(self):
+        if self.pinyin_list:
+            k = len(self.pinyin_list)
+            self.pinyin_list.pop()
+            changed = k
+            for i, _ in self.ends.pop():
+                self.starts[i] -= 1
+                if self.starts[i] == 0:
+                    changed = min(changed, i + 1)  # i 到 i+1 的单个拼音边恢复
+            self.starts.pop()
+            self.relax(changed)
+
+    # 从位置 start 起重算 best 和 back 直到最后一个拼音
+    def relax(self, start):
+        del self.best[start:]
+        del self.back[start:]
+        for k in range(start, len(self.pinyin_list) + 1):
+            candidates = [(self.best[i] + prob, i) for i, prob in self.ends[k]]
+            if self.starts[k - 1] == 0:
+                # 无匹配时，按单个拼音前进
+                candidates.append((self.best[k - 1] + self.searcher.calc_prob(self.pinyin_list, k - 1, k), k - 1))
+            score, i = max(candidates) if candidates else (float('-inf'), k - 1)  # k 不可达
+            self.best.append(score)
+            self.back.append(i)
+
+    # 回溯当前最优路径, 生成汉字或原始拼音输出
+    def current_best(self):
+        route = dict()
+        j = len(self.pinyin_list)
+        while j > 0:
+            i = self.back[j]
+            route[i] = (self.best[j], j)
+            j = i
+        return self.searcher.decode_pinyin_path(self.pinyin_list, route)
+
 def is_latin_alnum(char):
     return char.isascii() and char.isalnum()
 
@@ -322,38 +1126,197 @@ def format_result(result):
         output.append(token)
     return ''.join(output)
 
+# 解码一行拼音, 返回格式化后的文本
+def decode_line(line, searcher):
+    return format_result(searcher.search(split_pinyin_and_punct(line)))
+
+# 解码一批行: 相同的行只解码一次; 使用进程池时, 由父进程的结果缓存过滤已解码的行;
+# vectorized 时由 search_batch 同时递推整批
+def decode_batch(lines, searcher, pool=None, vectorized=False):
+    unique = list(dict.fromkeys(lines))
+    if pool:
+        cache = searcher.result_cache
+        tokens = [tuple(split_pinyin_and_punct(line)) for line in unique]
+        results = [cache.get(t) if cache else None for t in tokens]
+        missing = [i for i, result in enumerate(results) if result is None]
+        for i, (result, complete) in zip(missing, pool.map(decode_worker_tokens, [tokens[i] for i in missing], chunksize=64)):
+            results[i] = result
+            if cache and complete:
+                cache.put(tokens[i], result)
+        decoded = dict(zip(unique, map(format_result, results)))
+    elif vectorized:
+        results = searcher.search_batch([split_pinyin_and_punct(line) for line in unique])
+        decoded = dict(zip(unique, map(format_result, results)))
+    else:
+        decoded = {line: decode_line(line, searcher) for line in unique}
+    return [decoded[line] for line in lines]
+
+# 按后端打开词典: sqlite 数据库, 或 flat_dict.py 编译的内存映射文件
+def open_dict(path, backend='sqlite', metrics=None, overlays=()):
+    if backend == 'mmap':
+        db = MmapFlatDict(path)
+        db.metrics = metrics
+        return db
+    return DB(path, metrics=metrics, overlays=overlays)
+
+# 解析 --overlay 的 <path>[:<boost>]
+def parse_overlay(arg):
+    path, sep, boost = arg.rpartition(':')
+    try:
+        return (path, float(boost)) if sep else (arg, 1.0)
+    except ValueError:
+        return (arg, 1.0)
+
+# 多进程解码: 各worker附加到同一个共享内存词典, 或映射同一个词典文件, 不各自复制词典
+kWorkerSearcher = None
+
+def set_worker_dict(name=None, path=None, budget_seconds=None, budget_work=None):
+    global kWorkerSearcher
+    db = SharedFlatDict.attach(name) if name else MmapFlatDict(path)
+    kWorkerSearcher = DAGViterbiSearcher(db, budget_seconds=budget_seconds, budget_work=budget_work)
+
+def decode_worker_line(line):
+    return decode_line(line, kWorkerSearcher)
+
+# 返回结果, 以及它是否完整(未因预算降级), 只有完整的结果进入父进程的结果缓存
+def decode_worker_tokens(tokens):
+    budget = kWorkerSearcher.new_budget()
+    result = kWorkerSearcher.search(list(tokens), budget=budget)
+    return result, budget is None or budget.tier == 'viterbi'
+
+
+# 读取非空行
+def get_input_lines(fin):
+    for line in fin:
+        line = line.strip()
+        if line:
+            yield line
+
+# 按批读取非空行
+def get_input_batches(fin, batch_size):
+    batch = []
+    for line in get_input_lines(fin):
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 # 主流程
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     parser = argparse.ArgumentParser()
     parser.add_argument('--dict', default='txt/dict.db', help='词典文件路径')
+    parser.add_argument('--backend', choices=['sqlite', 'mmap'], default='sqlite', help='词典后端, mmap 读取 flat_dict.py 编译的文件')
     parser.add_argument('--import_data', default=None, help='需要導入的數據文件')
+    parser.add_argument('--overlay', action='append', default=[], help='叠加的词典, 可多次指定, 后者优先, 可带词频加权如 txt/user.db:2')
+    parser.add_argument('--migrate', action='store_true', help='将旧版本的词典升级到当前的表结构')
+    parser.add_argument('--import_tables', nargs='+', default=None, help='直接導入的rime码表(.dict.yaml), 可配合 --dict :memory:')
     parser.add_argument('--input', default=None, help='输入拼音文件路径')
+    parser.add_argument('--profile', default=None, help='退出时将各阶段耗时写入JSON文件, "-" 表示stderr')
+    parser.add_argument('--cprofile', default=None, help='同时保存cProfile统计数据的文件路径')
+    parser.add_argument('--trace_memory', action='store_true', help='配合 --profile 记录内存峰值(会拖慢各阶段计时)')
+    parser.add_argument('--metrics_file', default=None, help='退出时以Prometheus文本格式写出指标')
+    parser.add_argument('--metrics_port', type=int, default=None, help='在本地HTTP端口的 /metrics 上提供指标')
+    parser.add_argument('--workers', type=int, default=1, help='解码的进程数, 大于1时各进程共享一份导出到共享内存的词典')
+    parser.add_argument('--batch_size', type=int, default=1000, help='每批读取的行数, 同一批中相同的行只解码一次')
+    parser.add_argument('--vectorized', action='store_true', help='用 numpy 同时递推每批的所有行, 用于离线批量解码, 不能与 --workers 和预算同用')
+    parser.add_argument('--result_cache', type=int, default=10000, help='内存中缓存的解码结果数, 0 表示不缓存')
+    parser.add_argument('--budget_ms', type=float, default=None, help='每行的搜索时间预算(毫秒), 用完后降级为正向最大匹配或原样输出')
+    parser.add_argument('--budget_work', type=int, default=None, help='每行的搜索工作量预算(词图中的词典查询次数)')
+    parser.add_argument('--cache_snapshot', default=None, help='启动时载入的词频缓存快照文件, 按词典版本区分')
+    parser.add_argument('--prewarm', default=None, help='解码样本输入文件, 将最常用的缓存条目写入 --cache_snapshot 后退出')
+    parser.add_argument('--snapshot_size', type=int, default=100000, help='缓存快照保存的最多条目数')
+    parser.add_argument('--result_cache_db', default=None, help='解码结果的磁盘缓存(sqlite)文件, 按词典版本区分')
     args = parser.parse_args()
 
-    db = DB(args.dict)
+    if args.profile:
+        profiling.enable(args.profile, args.cprofile, args.trace_memory)
+
+    metrics = None
+    if args.metrics_file or args.metrics_port is not None:
+        metrics = DecoderMetrics()
+        if args.metrics_port is not None:
+            metrics.registry.serve(args.metrics_port)
+
+    if args.backend == 'mmap' and (args.import_data or args.import_tables or args.overlay or args.cache_snapshot):
+        sys.stderr.write("Error: the mmap dictionary is read-only, compile it with flat_dict.py\n")
+        sys.exit(-1)
+    db = open_dict(args.dict, args.backend, metrics, [parse_overlay(arg) for arg in args.overlay])
+
+    if args.migrate:
+        if db.migrate():
+            print("Ok, Dictionary migrated!")
+        else:
+            print("Ok, Dictionary is up to date.")
+        sys.exit(0)
 
     if args.import_data:
         db.import_data(args.import_data)
         print("Ok, Data imported!")
         sys.exit(0)
 
+    if args.import_tables:
+        db.import_tables(args.import_tables)
+        if not args.input:
+            print("Ok, Tables imported!")
+            sys.exit(0)
+
+    if args.prewarm:
+        if not args.cache_snapshot:
+            sys.stderr.write("Error: --prewarm requires --cache_snapshot\n")
+            sys.exit(-1)
+        db.track_access()
+        searcher = DAGViterbiSearcher(db)
+        with open(args.prewarm, 'r', encoding='utf-8') as fin:
+            for line in get_input_lines(fin):
+                decode_line(line, searcher)
+        count = db.dump_cache_snapshot(args.cache_snapshot, args.snapshot_size)
+        print("Ok, %d cache entries saved to %s" % (count, args.cache_snapshot))
+        sys.exit(0)
+
     if not args.input:
         parser.print_help()
         sys.stderr.write("Error: --input is required\n")
         sys.exit(-1)
 
-    dvsearcher = DAGViterbiSearcher(db)
+    if args.cache_snapshot:
+        db.load_cache_snapshot(args.cache_snapshot)
+
+    budget_seconds = args.budget_ms / 1000 if args.budget_ms is not None else None
+    if args.vectorized and (args.workers > 1 or budget_seconds is not None or args.budget_work is not None):
+        sys.stderr.write("Error: --vectorized decodes in this process without a budget\n")
+        sys.exit(-1)
+    shared = None
+    pool = None
+    if args.workers > 1:
+        from multiprocessing import Pool
+        if args.backend == 'mmap':
+            pool = Pool(args.workers, initializer=set_worker_dict, initargs=(None, args.dict, budget_seconds, args.budget_work))
+        else:
+            shared = SharedFlatDict.create(db)
+            pool = Pool(args.workers, initializer=set_worker_dict, initargs=(shared.name, None, budget_seconds, args.budget_work))
+    result_cache = None
+    if args.result_cache > 0 or args.result_cache_db:
+        result_cache = ResultCache(args.result_cache, args.result_cache_db, db.get_dict_version())
+    dvsearcher = DAGViterbiSearcher(db, result_cache=result_cache, budget_seconds=budget_seconds, budget_work=args.budget_work)
 
     with open(args.input, 'r', encoding='utf-8') as fin:
-        for line in fin:
-            line = line.strip()
-            if not line:
-                continue
-            pinyin_list = split_pinyin_and_punct(line)
-            # 预取词频数据
-            db.prefetch_word_freq(pinyin_list)
-            result = dvsearcher.search(pinyin_list)
-            print(format_result(result))
+        for batch in get_input_batches(fin, args.batch_size):
+            results = decode_batch(batch, dvsearcher, pool, args.vectorized)
+            with profiling.stage('output'):
+                for result in results:
+                    print(result)
+
+    if pool:
+        pool.close()
+        pool.join()
+    if shared:
+        shared.close()
+    if result_cache:
+        result_cache.close()
 
+    if args.metrics_file:
+        metrics.registry.write_file(args.metrics_file)
     db.close()
@@ -3,7 +3,16 @@ import os
 import re
 import argparse
 import copy
+import json
+import glob
+import heapq
+import pickle
+import sqlite3
 import unicodedata
+from itertools import product
+from multiprocessing import Pool
+
+import profiling
 
 # define constants for post-fixes
 POSTFIX_MAPPING = """
@@ -263,6 +272,7 @@ PINYIN_CODE = "pinyin.txt"
 PINYIN_SIMP_DICT = "pinyin_trad.dict.txt"
 PINYIN_SIMP_EXT1_DICT = "pinyin_trad_ext1.dict.txt"
 PINYIN_PHRASE = "pinyin_phrase.txt"
+FREQUENCY_CACHE_DIR = "txt"
 
 def get_postfix_mapping():
     mapping = dict()
@@ -344,6 +354,60 @@ def get_pinvin_seq(pinyin_seq):
 def get_toneless_pinyin_seq(pinyin_seq):
     return [get_toneless_pinyin(pinyin) for pinyin in pinyin_seq]
 
+def begin_with_vowel(encode):
+    return encode[0] in ['a', 'o', 'e', 'i', 'u', 'y', 'w']
+
+# Intern the tonal pinyin syllables as integer ids, so that the readings of words are
+# compact tuples of ids, and the toneless and pinvin forms are derived once per syllable.
+class SyllableTable:
+    def __init__(self):
+        self.ids = dict()       # syllable -> id
+        self.syllables = []     # id -> syllable
+        self.toneless = []      # id -> toneless pinyin
+        self.pinvins = []       # id -> pinvin
+        self.vowels = []        # id -> whether the pinvin begins with a vowel
+
+    def intern(self, syllable):
+        sid = self.ids.get(syllable)
+        if sid is None:
+            sid = len(self.syllables)
+            self.ids[syllable] = sid
+            self.syllables.append(syllable)
+            self.toneless.append(get_toneless_pinyin(syllable))
+            pinvin = get_pinvin(syllable)
+            self.pinvins.append(pinvin)
+            self.vowels.append(begin_with_vowel(pinvin))
+        return sid
+
+    def intern_seq(self, seq):
+        return tuple(self.intern(syllable) for syllable in seq)
+
+    # intern a dictionary of character codes, e.g. kPinyinCodes
+    # return a dictionary of character and a tuple of syllable ids
+    def intern_codes(self, codes):
+        return {ch: self.intern_seq(pys) for ch, pys in codes.items()}
+
+    # intern a dictionary of words and lists of pinyin code sequences, e.g. get_pinyin_phrases()
+    def intern_phrases(self, words):
+        return {word: [self.intern_seq(seq) for seq in words[word]] for word in words}
+
+    def decode(self, ids):
+        return [self.syllables[sid] for sid in ids]
+
+    # the same as ' '.join(get_toneless_pinyin_seq(self.decode(ids)))
+    def get_toneless(self, ids):
+        return ' '.join([self.toneless[sid] for sid in ids])
+
+    # the same as get_pinvin_seq(self.decode(ids))
+    def get_pinvin_seq(self, ids):
+        pinvin_seq = [self.pinvins[sid] for sid in ids]
+        for i in range(1, len(ids)):
+            if self.vowels[ids[i]]:
+                pinvin_seq[i] = 'v' + pinvin_seq[i]
+        return pinvin_seq
+
+kSyllables = SyllableTable()
+
 # get chinese code from a file with format "pinyin: word1 word2 ..."
 def get_standard_code_from_file(file):
     words = dict()
@@ -415,15 +479,18 @@ def get_pinyin_phrases():
 
 kPinyinCodes = get_pinyin_code_from_file(PINYIN_CODE)
 kStandardCodes = get_standard_code_from_file(STANDARD_CHINESE)
+# the same codes as tuples of syllable ids, for generating the tables
+kPinyinCodeIds = kSyllables.intern_codes(kPinyinCodes)
+kStandardCodeIds = kSyllables.intern_codes(kStandardCodes)
 
 # Merge kStandardCodes and kPinyinCodes, then return the new dictionary
 def merge_codes():
     codes = dict()
     for word in kStandardCodes:
-        codes[word] = copy.deepcopy(kStandardCodes[word])
+        codes[word] = list(kStandardCodes[word])
     for word in kPinyinCodes:
         if word not in codes:
-            codes[word] = copy.deepcopy(kPinyinCodes[word])
+            codes[word] = list(kPinyinCodes[word])
         else:
             for pinyin in kPinyinCodes[word]:
                 if pinyin not in codes[word]:
@@ -436,7 +503,6 @@ kMergedCodes = merge_codes()
 # word: a list of characters, e.g. ['character1', 'character2']
 # word_code: a list of tonal pinyin code sequences, e.g. [['code1', 'code2'], ['code3', 'code4']]
 # char_codes: a dictionary of characters and a list of pinyin code sequences, e.g. {'character': ['code1', 'code2']}
-# Notes: a word is a list of characters, and the function should not use get_descartes_products
 def is_consistent(word, word_code, char_codes, strict=True):
     if len(word) != len(word_code):
         return False
@@ -453,10 +519,10 @@ def is_consistent(word, word_code, char_codes, strict=True):
 
 # purge inconsistent phrases
 def purge_inconsistent_phrases(words, strict=True):
-    char_codes = get_pinyin_code_of_chars()
+    index = get_reading_index()
     for word in get_sorted_keys(words):
         for pinyin_seq in words[word]:
-            if not is_consistent(word, pinyin_seq, char_codes, strict = strict):
+            if not index.is_consistent(word, pinyin_seq, strict = strict):
                 del words[word]
                 break
 
@@ -465,11 +531,11 @@ def purge_inconsistent_phrases(words, strict=True):
 #  If strict is True, if any character of the word is not found in the char_codes, the word is inconsistent;
 #  otherwise, only when the first character is not found in the char_codes, the word is inconsistent.
 def get_inconsistent_phrases(words, strict=True):
-    char_codes = get_pinyin_code_of_chars()
+    index = get_reading_index()
     inconsistent = dict()
     for word in get_sorted_keys(words):
         for pinyin_seq in words[word]:
-            if not is_consistent(word, pinyin_seq, char_codes, strict = strict):
+            if not index.is_consistent(word, pinyin_seq, strict = strict):
                 if word not in inconsistent:
                     inconsistent[word] = []
                 inconsistent[word].append(pinyin_seq)
@@ -498,13 +564,25 @@ def get_pinyin_code_of_chars(reviseDe = False):
             words[word] = remove_from(words[word], ['di', 'dī'])
     return words
 
+kRevisedDe = {'地': ['de'], '得': ['de'], '的': ['di', 'dī']}
+
+# get the interned pinyin codes of chinese characters, the same as get_pinyin_code_of_chars
+# return a dictionary of character and a tuple of syllable ids
+def get_interned_code_of_chars(reviseDe = False):
+    words = dict(kPinyinCodeIds)
+    words.update(kStandardCodeIds)
+    if reviseDe:
+        for word, removed in kRevisedDe.items():
+            if word in kStandardCodeIds:
+                removed = set(kSyllables.intern(py) for py in removed)
+                words[word] = tuple(sid for sid in words[word] if sid not in removed)
+    return words
+
 # get pinyin codes of characters
-# return a dictionary of word and a list of pinyin code sequences
+# return a dictionary of word and a list of pinyin code sequences, as tuples of syllable ids
 def get_code_of_chars_in_list():
-    words = get_pinyin_code_of_chars()
-    for word in words:
-        words[word] = [[pinyin] for pinyin in words[word]]
-    return words
+    words = get_interned_code_of_chars()
+    return {word: [(sid,) for sid in words[word]] for word in words}
  
  # read words from file
 def get_words_from_file(file):
@@ -518,9 +596,6 @@ def get_words_from_file(file):
             words.append(word[0])
     return words
 
-def begin_with_vowel(encode):
-    return encode[0] in ['a', 'o', 'e', 'i', 'u', 'y', 'w']
-
 # prepend 'v' to non-first elements in a list of encodes beginning with 'a,o,e,i,u,y,w'
 def prepend_v(encodes):
     for i in range(1, len(encodes)):
@@ -529,21 +604,15 @@ def prepend_v(encodes):
             encodes[i] = 'v' + encode
     return encodes
 
-# get all descartes products of encodes which is a list of list of elements
-def get_descartes_products(encodes):
-    descartes = [[]]
-    for encode in encodes:
-        new_descartes = []
-        for descarte in descartes:
-            for element in encode:
-                new_descartes.append(descarte + [element])
-        descartes = new_descartes
-    return descartes
-
 # get the pinyin code of words from a list of words
-# return a dictionary of word and a list of tonal pinyin code sequences
+# return a dictionary of word and a list of tonal pinyin code sequences, as tuples
+# of syllable ids of kSyllables which kSyllables.decode turns back into strings
 def get_code_of_words(words: list) -> dict:
-    char_codes = get_pinyin_code_of_chars(reviseDe = True)
+    with profiling.stage('codes'):
+        return _get_code_of_words(words)
+
+def _get_code_of_words(words):
+    char_codes = get_interned_code_of_chars(reviseDe = True)
     word_codes = dict()
     for word in words:
         word_codes[word] = []
@@ -558,30 +627,72 @@ def get_code_of_words(words: list) -> dict:
             encodes.append(char_codes[char])
         if on_error:
             continue
-        word_codes[word] = get_descartes_products(encodes)
+        word_codes[word] = list(product(*encodes))
     return word_codes
 
-# get the frequency of words from a file
-def get_frequency_from_file(file):
-    freq = dict()
-    with open(file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            word, code, frequency = line.split('\t')
-            if word not in freq:
-                freq[word] = dict()
-            if code not in freq[word]:
-                freq[word][code] = 0
-            freq[word][code] += int(frequency)
-    return freq
-
-# get the frequency of a character from freq_dict with default value 0.
-def get_freq_of_word(word, toneless_code, freq_dict):
-    if word not in freq_dict:
-        return 0
-    if toneless_code not in freq_dict[word]:
-        return 0
-    return freq_dict[word][toneless_code]
+FREQUENCY_STORE_VERSION = 1
+
+# A frequency store keyed by the single key "word\ttoneless-code", compiled once from a
+# frequency file "word\tcode\tfreq" into a pickled artifact which is loaded in one read
+class FrequencyStore:
+    def __init__(self, freqs=None, source=None):
+        self.freqs = freqs if freqs is not None else dict()
+        self.source = source  # (size, mtime) of the frequency file
+
+    @classmethod
+    def from_file(cls, file):
+        freqs = dict()
+        with open(file, 'r') as f:
+            for line in f:
+                key, _, frequency = line.strip().rpartition('\t')
+                freqs[key] = freqs.get(key, 0) + int(frequency)
+        return cls(freqs, get_file_stamp(file))
+
+    # load an artifact, or return None if it is unreadable or of another version
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data["version"] != FREQUENCY_STORE_VERSION:
+                return None
+            return cls(data["freqs"], data["source"])
+        except Exception as e:
+            print("Rebuilding the frequency store", path, ":", e, file=sys.stderr)
+            return None
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        data = {"version": FREQUENCY_STORE_VERSION, "source": self.source, "freqs": self.freqs}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def get(self, word, toneless_code):
+        return self.freqs.get(word + '\t' + toneless_code, 0)
+
+    # the frequencies of a list of "word\ttoneless-code" keys, with default value 0
+    def lookup_many(self, keys):
+        get = self.freqs.get
+        return [get(key, 0) for key in keys]
+
+def get_file_stamp(file):
+    stat = os.stat(file)
+    return (stat.st_size, stat.st_mtime_ns)
+
+# load the frequency store of a file from its compiled artifact in cache_dir, which is
+# (re)built when missing, unreadable or compiled from another version of the file
+def load_frequency_store(file, cache_dir=FREQUENCY_CACHE_DIR):
+    with profiling.stage('frequency'):
+        path = os.path.join(cache_dir, os.path.basename(file) + '.freq')
+        if os.path.exists(path):
+            store = FrequencyStore.load(path)
+            if store and store.source == get_file_stamp(file):
+                return store
+        store = FrequencyStore.from_file(file)
+        store.save(path)
+        return store
 
 # get the sorted keys of a dictionary
 def get_sorted_keys(dict):
@@ -600,8 +711,11 @@ def get_prepended_v_seqs(pinvin_seq):
 #   e.g. {'pinyin': {'char': ['word1', 'word2']}}
 def get_inconsistent_chars():
     pinyin_phrases = get_pinyin_phrases()
-    codes = get_pinyin_code_of_chars()
     inconsistent = get_inconsistent_phrases(pinyin_phrases, strict = False)
+    return get_chars_of_inconsistent_phrases(inconsistent)
+
+def get_chars_of_inconsistent_phrases(inconsistent):
+    codes = get_reading_index().codes
     chars = dict()
     for word in inconsistent:
         for pinyin_seq in inconsistent[word]:
@@ -618,35 +732,173 @@ def get_inconsistent_chars():
                 chars[py][ch].append(word)
     return chars
 
+# a (word, code) index shared by all the generated tables, which assigns each row to exactly
+# one table: the table first in `order` keeps the row, or the first table generated on ties.
+# Regenerating a table first releases its own rows, so the tables can be rebuilt one by one.
+# The rows dropped from the current table are recorded with their owner, see get_duplicates.
+#   path: the sqlite file of the index, e.g. txt/dedup.db
+#   table: the name of the table being generated
+#   order: the names of the tables by priority, e.g. the order of the Makefile
+class DedupIndex:
+    def __init__(self, path, table, order=()):
+        self.path = path
+        self.table = table
+        self.priority = order.index(table) if table in order else len(order)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS owners (
+                word TEXT NOT NULL,
+                code TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                priority INTEGER,
+                PRIMARY KEY (word, code)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS duplicates (
+                tbl TEXT NOT NULL,
+                word TEXT NOT NULL,
+                code TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                PRIMARY KEY (tbl, word, code)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("DELETE FROM owners WHERE owner = ?", (table,))
+        self.conn.execute("DELETE FROM duplicates WHERE tbl = ?", (table,))
+        self.owners = {(word, code): (owner, priority) for word, code, owner, priority
+                       in self.conn.execute("SELECT word, code, owner, priority FROM owners")}
+        self.claimed = []
+        self.removed = []
+        self.taken = set()
+        self.duplicates_within = 0
+
+    # keep the row in the current table, unless a table of higher or equal priority owns it
+    def claim(self, word, code):
+        owner = self.owners.get((word, code))
+        if owner and owner[1] <= self.priority:
+            self.removed.append((self.table, word, code, owner[0]))
+            return False
+        if owner:
+            self.taken.add(owner[0])  # the owner has to be regenerated without the row
+        self.owners[(word, code)] = (self.table, self.priority)
+        self.claimed.append((word, code, self.table, self.priority))
+        return True
+
+    # write the claimed rows and the duplicates into the index, reporting them to stderr
+    def close(self):
+        self.conn.executemany("INSERT OR REPLACE INTO owners (word, code, owner, priority) VALUES (?,?,?,?)", self.claimed)
+        self.conn.executemany("INSERT OR REPLACE INTO duplicates (tbl, word, code, owner) VALUES (?,?,?,?)", self.removed)
+        self.conn.commit()
+        self.conn.close()
+        counts = dict()
+        for _, _, _, owner in self.removed:
+            counts[owner] = counts.get(owner, 0) + 1
+        summary = ', '.join("%d in %s" % (counts[owner], owner) for owner in sorted(counts))
+        print("%s: removed %d duplicate rows%s, %d within the table" % (self.table, len(self.removed),
+              " (%s)" % summary if summary else '', self.duplicates_within), file=sys.stderr)
+        for owner in sorted(self.taken):
+            print("%s: took rows of %s, which should be regenerated" % (self.table, owner), file=sys.stderr)
+
+# the rows removed from the tables as duplicates, as (table, word, code, owner) sorted by table
+def get_duplicates(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT tbl, word, code, owner FROM duplicates ORDER BY tbl, word, code").fetchall()
+    finally:
+        conn.close()
+
 # print the word_codes which is a dictionary of key,list into a file with the format of word code frequency
-# word_codes: a dictionary of word and a list of tonal pinyin code sequences,
-#               e.g. {'word': [['code1', 'code2'], ['code3', 'code4']]}
-def print_word_codes(word_codes, words_freq, fluent=True, outfile=sys.stdout):
-    codes = dict()
+# word_codes: a dictionary of word and a list of tonal pinyin code sequences as tuples of syllable ids,
+#               e.g. {'word': [(id1, id2), (id3, id4)]}, see kSyllables.intern_phrases
+# words_freq: a FrequencyStore
+# db: an optional convert_to_chinese.DB which the (pinyin, word, freq) rows are written into as well
+# dedup: an optional DedupIndex which the rows of other tables are removed with
+def print_word_codes(word_codes, words_freq, fluent=True, outfile=sys.stdout, db=None, dedup=None):
+    with profiling.stage('output'):
+        _print_word_codes(word_codes, words_freq, fluent, outfile, db, dedup)
+
+def _print_word_codes(word_codes, words_freq, fluent, outfile, db, dedup=None):
+    records, duplicates = get_code_records(word_codes, words_freq, fluent)
+    write_code_records(records, outfile, db, dedup, duplicates)
+
+# the (length, code, word, freq) records of word_codes in the order of the table, and the number
+# of codes repeated within a word, from several readings or from prepending v
+def get_code_records(word_codes, words_freq, fluent=True):
+    seqs = []
+    keys = []
     for word in word_codes:
-        length = len(word)
         for pinyin_seq in word_codes[word]:
-            toneless = ' '.join(get_toneless_pinyin_seq(pinyin_seq))
-            freq = get_freq_of_word(word, toneless, words_freq)
-            for pinvin_seq in get_prepended_v_seqs(get_pinvin_seq(pinyin_seq)):
-                sep = ' ' if fluent else ''
-                code = sep.join(pinvin_seq)
-                if length not in codes:
-                    codes[length] = dict()
-                if code not in codes[length]:
-                    codes[length][code] = dict()
-                codes[length][code][word] = freq
-
-    for length in get_sorted_keys(codes):
-        for code in get_sorted_keys(codes[length]):
-            for word in get_sorted_keys(codes[length][code]):
-                freq = codes[length][code][word]
-                print("%s\t%s\t%i" % (word, code, freq), file=outfile)
-
-def show_discrepencies_from_standard():
+            seqs.append((word, pinyin_seq))
+            keys.append(word + '\t' + kSyllables.get_toneless(pinyin_seq))
+    freqs = words_freq.lookup_many(keys)
+    del keys
+
+    # a flat dict keyed by (length, code, word) sorts the same as nested dicts, without a dict per code
+    codes = dict()
+    sep = ' ' if fluent else ''
+    duplicates = 0  # the same code of a word from several readings, or from prepending v
+    for (word, ids), freq in zip(seqs, freqs):
+        length = len(word)
+        for pinvin_seq in get_prepended_v_seqs(kSyllables.get_pinvin_seq(ids)):
+            code = sep.join(pinvin_seq)
+            if (length, code, word) in codes:
+                duplicates += 1
+            codes[(length, code, word)] = freq
+    del seqs, freqs
+    return [key + (codes[key],) for key in sorted(codes)], duplicates
+
+def write_code_records(records, outfile, db=None, dedup=None, duplicates=0):
+    entries = []
+    for length, code, word, freq in records:
+        if dedup and not dedup.claim(word, code):
+            continue
+        print("%s\t%s\t%i" % (word, code, freq), file=outfile)
+        if db:
+            entries.append((code.replace(' ', '').lower(), word, freq))
+    if db:
+        db.import_entries(entries)
+    if dedup:
+        dedup.duplicates_within += duplicates
+
+# the frequency store and the fluent mode of the code generation workers
+kCodeWorker = None
+
+def set_code_worker(words_freq, fluent):
+    global kCodeWorker
+    kCodeWorker = (words_freq, fluent)
+
+def get_code_records_of_chunk(words):
+    words_freq, fluent = kCodeWorker
+    return get_code_records(_get_code_of_words(words), words_freq, fluent)
+
+# merge the sorted records of the chunks, dropping the repeats of a word listed in several chunks
+def merge_code_records(chunk_records):
+    last = None
+    for record in heapq.merge(*chunk_records):
+        if record[:3] != last:
+            last = record[:3]
+            yield record
+
+# print the codes of a word list as print_word_codes(get_code_of_words(words), ...) does, with
+# jobs > 1 generating the records of chunks of the list in worker processes, which are forked
+# with the code tables and the frequency store, and merging the sorted chunks
+def print_code_of_words(words, words_freq, fluent=True, outfile=sys.stdout, db=None, dedup=None, jobs=1, chunk_size=10000):
+    if jobs <= 1:
+        print_word_codes(get_code_of_words(words), words_freq, fluent, outfile, db, dedup)
+        return
+    with profiling.stage('codes'):
+        with Pool(jobs, initializer=set_code_worker, initargs=(words_freq, fluent)) as pool:
+            results = pool.map(get_code_records_of_chunk, get_chunks(words, chunk_size))
+    with profiling.stage('output'):
+        write_code_records(merge_code_records([records for records, _ in results]), outfile, db, dedup,
+                           sum(duplicates for _, duplicates in results))
+
+# get the pinyin of characters which are not in the standard codes, grouped by toneless pinyin,
+#   e.g. {'toneless': {'pinyin': ['char1', 'char2']}}
+def get_discrepencies_from_standard():
     diffs = dict()
     for ch in kStandardCodes:
-        pys = copy.deepcopy(kPinyinCodes[ch])
+        pys = copy.deepcopy(kPinyinCodes.get(ch, []))
         for py in kStandardCodes[ch]:
             if py in pys:
                 pys.remove(py)
@@ -659,18 +911,29 @@ def show_discrepencies_from_standard():
             if py not in diffs[toneless]:
                 diffs[toneless][py] = []
             diffs[toneless][py].append(ch)
+    return diffs
 
+# show the discrepancies of the validation report if given, otherwise only those are computed
+def show_discrepencies_from_standard(report=None):
+    if report is None:
+        diffs = get_discrepencies_from_standard()
+    else:
+        diffs = report["standard_discrepancies"]
     for toneless in get_sorted_keys(diffs):
         print("#", toneless, file=sys.stdout)
         for py in get_sorted_keys(diffs[toneless]):
             print(py,":", ", ".join(diffs[toneless][py]), file=sys.stdout)
 
-def show_inconsistent_chars(type):
+# show the inconsistent characters of the validation report if given, otherwise only those are computed
+def show_inconsistent_chars(type, report=None):
     if type == '3':
-        show_discrepencies_from_standard()
+        show_discrepencies_from_standard(report)
         return
 
-    chars = get_inconsistent_chars()
+    if report is None:
+        chars = get_inconsistent_chars()
+    else:
+        chars = report["inconsistent_chars"]
     print("#")
     for py in get_sorted_keys(chars):
         for ch in get_sorted_keys(chars[py]):
@@ -739,44 +1002,51 @@ def is_newline(ch):
         return False
     return ch[-1] in ['\n', '\r']
 
-def convert_text(text, userdict=None):
-    import jieba
-    from pypinyin import pinyin, Style
-    from itertools import chain
+# annotator: a lexicon.PinvinAnnotator, which defaults to the one of the compiled lexicon
+# segmenter: anything with lcut and load_userdict such as jieba, which defaults to a
+#            lexicon.Segmenter sharing the lexicon of the annotator
+# outfile: where the pinvin is written, e.g. an io.StringIO to keep it
+def convert_text(text, userdict=None, annotator=None, segmenter=None, outfile=sys.stdout):
+    import lexicon
 
+    if annotator is None:
+        annotator = lexicon.PinvinAnnotator(lexicon.load_lexicon())
+    if segmenter is None:
+        segmenter = lexicon.Segmenter(annotator.lexicon)
     if userdict:
-        jieba.load_userdict(userdict)
+        segmenter.load_userdict(userdict)
 
-# 使用 jieba 分词
-    words = jieba.lcut(text)
+# 分词
+    with profiling.stage('segment'):
+        words = segmenter.lcut(text)
 
-# 使用 pypinyin 为每个词注音（带调号）
+# 使用我们自己的码表为每个词注音, pypinyin 仅作为最后的后备
     pinvins = []
-    for word in words:
-        if is_ascii(word):
-            pinvins.append([word])
-            continue
-        pys = pinyin(word, style=Style.TONE, strict=False)
-        pvs = get_pinvin_seq(list(chain.from_iterable(pys)))
-        pinvins.append(pvs)
+    with profiling.stage('annotate'):
+        for word in words:
+            if is_ascii(word):
+                pinvins.append([word])
+                continue
+            pinvins.append(annotator.annotate(word))
 
-    is_start = True
-    for pvs in pinvins:
-        if len(pvs) == 0:
-            continue
-        if is_punctuation(pvs[0]):
-            pvs[0] = pvs[0].translate(kUnicodePunctMaps)
-        if is_start:
-            cap = pvs[0].capitalize()
-            pvs[0] = cap
-            if len(cap) > 0 and cap[0].isalnum():
-                is_start = False
-        elif is_period(pvs[-1]) or is_newline(pvs[-1]):
-            is_start = True
-        if not is_punctuation(pvs[0]):
-            sys.stdout.write(' ')
-        sys.stdout.write(''.join(pvs))
-    sys.stdout.write('\n')
+    with profiling.stage('output'):
+        is_start = True
+        for pvs in pinvins:
+            if len(pvs) == 0:
+                continue
+            if is_punctuation(pvs[0]):
+                pvs[0] = pvs[0].translate(kUnicodePunctMaps)
+            if is_start:
+                cap = pvs[0].capitalize()
+                pvs[0] = cap
+                if len(cap) > 0 and cap[0].isalnum():
+                    is_start = False
+            elif is_period(pvs[-1]) or is_newline(pvs[-1]):
+                is_start = True
+            if not is_punctuation(pvs[0]):
+                outfile.write(' ')
+            outfile.write(''.join(pvs))
+        outfile.write('\n')
 
 def get_header(name, input_tables):
     hdr = f"""# rime dictionary
@@ -794,19 +1064,157 @@ sort: by_weight
     hdr += "...\n"
     return hdr
 
-# compare the code of standard chinese and pinyin, if not match, print both of them
-def compare_code():
+# get the characters of standard chinese whose codes differ from the pinyin codes, and those not found
+def get_code_differences():
     char_codes = get_pinyin_code_of_chars()
     standard_code = get_standard_code_from_file(STANDARD_CHINESE)
+    differences = dict()
+    missing = []
     for word in standard_code:
         if word not in char_codes:
-            print(word, "Not found", file=sys.stderr)
+            missing.append(word)
             continue
 
         standard_code[word].sort()
         char_codes[word].sort()
         if standard_code[word] != char_codes[word]:
-            print(word, standard_code[word], char_codes[word], file=sys.stdout)
+            differences[word] = {"standard": standard_code[word], "pinyin": char_codes[word]}
+    return differences, missing
+
+# compare the code of standard chinese and pinyin, if not match, print both of them.
+# The differences are taken from the validation report if given, otherwise only those are computed
+def compare_code(report=None):
+    if report is None:
+        differences, missing = get_code_differences()
+    else:
+        differences, missing = report["code_differences"], report["missing_standard_chars"]
+    for word in missing:
+        print(word, "Not found", file=sys.stderr)
+    for word, codes in differences.items():
+        print(word, codes["standard"], codes["pinyin"], file=sys.stdout)
+
+# set-based reading indexes of the characters, built once and shared by all validations
+#   codes: the codes of get_pinyin_code_of_chars(), merged: kMergedCodes,
+#   pinvins: the pinvin of the merged codes, for checking the generated tables
+class ReadingIndex:
+    def __init__(self):
+        self.codes = {ch: set(pys) for ch, pys in get_pinyin_code_of_chars().items()}
+        self.revised = {ch: set(pys) for ch, pys in get_pinyin_code_of_chars(reviseDe = True).items()}
+        self.merged = {ch: set(pys) for ch, pys in kMergedCodes.items()}
+        self.pinvins = dict()
+
+    # the same as is_consistent(word, word_code, get_pinyin_code_of_chars(), strict)
+    def is_consistent(self, word, word_code, strict=True):
+        if len(word) != len(word_code):
+            return False
+        for i in range(len(word)):
+            if word[i] not in self.codes:
+                return False
+            if strict and word_code[i] not in self.codes[word[i]]:
+                return False
+            if not strict:
+                return word_code[i] in self.merged[word[i]]
+        return True
+
+    def get_pinvins(self, ch):
+        if ch not in self.pinvins:
+            self.pinvins[ch] = set(get_pinvin(py) for py in self.merged.get(ch, ()))
+        return self.pinvins[ch]
+
+    # check a row of a generated table, whose code is a fluent pinvin sequence
+    def is_consistent_row(self, word, code):
+        pinvin_seq = code.split(' ')
+        if len(pinvin_seq) != len(word):
+            return len(word) > 1 and ' ' not in code  # not fluent, unchecked
+        for i in range(len(word)):
+            pinvin = pinvin_seq[i]
+            pinvins = self.get_pinvins(word[i])
+            if pinvin not in pinvins and not (pinvin[0] == 'v' and pinvin[1:] in pinvins):
+                return False
+        return True
+
+kReadingIndex = None
+
+def get_reading_index():
+    global kReadingIndex
+    if kReadingIndex is None:
+        kReadingIndex = ReadingIndex()
+    return kReadingIndex
+
+# check chunks of (word, pinyin_seq) of phrases, returning the inconsistent ones
+def check_phrase_chunk(args):
+    items, strict = args
+    index = get_reading_index()
+    return [(word, seq) for word, seq in items if not index.is_consistent(word, seq, strict = strict)]
+
+# check chunks of words of a word list, returning the characters without codes
+def check_word_chunk(words):
+    codes = get_reading_index().revised
+    return [(ch, word) for word in words for ch in word if ch not in codes]
+
+# check chunks of rows of a generated table, returning the inconsistent ones
+def check_table_chunk(rows):
+    index = get_reading_index()
+    return [(word, code) for word, code in rows if not index.is_consistent_row(word, code)]
+
+def get_chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+def run_chunks(func, chunks, pool):
+    results = pool.imap(func, chunks) if pool else map(func, chunks)
+    return [item for result in results for item in result]
+
+# build a machine-readable validation report of the phrase sources in one pass, with
+#   sources: {path: {"type": ..., ...}} for the pinyin phrases, the word lists and the tables
+#   inconsistent_chars: {'pinyin': {'char': ['word1', 'word2']}}, see get_inconsistent_chars
+#   standard_discrepancies: see get_discrepencies_from_standard
+#   code_differences, missing_standard_chars: see get_code_differences
+# The checks of every source run in parallel chunks when jobs > 1.
+def build_validation_report(phrase_file=PINYIN_PHRASE, word_files=(), tables=(), jobs=1, chunk_size=10000):
+    get_reading_index()  # build the index before forking the workers
+    pool = Pool(jobs) if jobs > 1 else None
+    report = {"sources": dict()}
+    try:
+        inconsistent = dict()
+        if phrase_file and os.path.exists(phrase_file):
+            phrases = get_pinyin_phrase_from_file(phrase_file)
+            items = [(word, seq) for word in get_sorted_keys(phrases) for seq in phrases[word]]
+            source = {"type": "phrases", "count": len(items)}
+            for name, strict in [("inconsistent", True), ("inconsistent_loose", False)]:
+                found = dict()
+                chunks = [(chunk, strict) for chunk in get_chunks(items, chunk_size)]
+                for word, seq in run_chunks(check_phrase_chunk, chunks, pool):
+                    found.setdefault(word, []).append(seq)
+                source[name] = found
+            inconsistent = source["inconsistent_loose"]
+            report["sources"][phrase_file] = source
+
+        for path in word_files:
+            words = get_words_from_file(path)
+            missing = dict()
+            for ch, word in run_chunks(check_word_chunk, get_chunks(words, chunk_size), pool):
+                missing.setdefault(ch, []).append(word)
+            report["sources"][path] = {"type": "words", "count": len(words), "missing_chars": missing}
+
+        for path in tables:
+            from convert_to_chinese import get_rows_from_table
+            with open(path, 'r', encoding='utf-8') as f:
+                rows = [(word, code) for word, code, freq in get_rows_from_table(f)]
+            found = dict()
+            for word, code in run_chunks(check_table_chunk, get_chunks(rows, chunk_size), pool):
+                found.setdefault(word, []).append(code)
+            report["sources"][path] = {"type": "table", "count": len(rows), "inconsistent": found}
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    report["inconsistent_chars"] = get_chars_of_inconsistent_phrases(inconsistent)
+    report["standard_discrepancies"] = get_discrepencies_from_standard()
+    differences, missing = get_code_differences()
+    report["code_differences"] = differences
+    report["missing_standard_chars"] = missing
+    return report
 
 if __name__ == "__main__":
     # control output with a argparser as follows:
@@ -819,7 +1227,18 @@ if __name__ == "__main__":
     # --check_pinyin: check pinyin phrase
     # --show_inconsistent <type>: show inconsistent characters and words, with 0 for characters, otherwise for words
     # --compare_code: compare code of standard chinese and pinyin
+    # --validate [report]: write a json report of all validations of the phrases, word lists and tables
+    # --jobs <num>: the number of parallel workers of --validate and of the codes of <input_file>
     # --fluent: whether to print in fluent mode
+    # --profile <file>: dump per-stage timings as json at exit, '-' for stderr
+    # --cprofile <file>: also capture cProfile stats into the file
+    # --trace_memory: also record the peak memory with tracemalloc, which slows down the stages
+    # --lexicon <file>: the compiled lexicon used by --text to segment and annotate words
+    # --segmenter <lexicon|jieba>: segment the text with the compiled lexicon or with jieba
+    # --db <file>: also write the generated rows into the sqlite dictionary of convert_to_chinese.py
+    # --dedup_index <file>: drop the (word, code) rows already in other tables, recording the rows of this table
+    # --dedup_order <table1>...<tableN>: the tables by priority, the first keeping a duplicated row
+    # --show_duplicates <file>: print the rows removed as duplicates by a dedup index
     # <input_file>: the input file
 
     parser = argparse.ArgumentParser()
@@ -831,46 +1250,94 @@ if __name__ == "__main__":
     parser.add_argument("--check_pinyin", help="check pinyin phrase", action="store_true")
     parser.add_argument("--show_inconsistent", nargs='?', help="show inconsistent characters and words", default=None)
     parser.add_argument("--compare_code", help="compare code of standard chinese and pinyin", action="store_true")
+    parser.add_argument("--validate", nargs='?', const='-', help="write a json report of all validations", default=None)
+    parser.add_argument("--jobs", type=int, help="the number of parallel workers", default=1)
     parser.add_argument("--fluent", help="whether to print in fluent mode", action="store_true")
     parser.add_argument("--text", nargs="?", help="the text to be converted", default=None)
-    parser.add_argument("--userdict", nargs="?", help="the user dictionary for jieba", default=None)
+    parser.add_argument("--userdict", nargs="?", help="the user dictionary of the segmenter, in the jieba format", default=None)
+    parser.add_argument("--segmenter", choices=["lexicon", "jieba"], help="the segmenter for --text", default="lexicon")
+    parser.add_argument("--lexicon", help="the compiled lexicon for --text, rebuilt when stale", default="txt/lexicon.pickle")
+    parser.add_argument("--profile", help="dump per-stage timings as json at exit, '-' for stderr", default=None)
+    parser.add_argument("--cprofile", help="also capture cProfile stats into the file", default=None)
+    parser.add_argument("--trace_memory", action="store_true", help="also record the peak memory with tracemalloc")
+    parser.add_argument("--db", help="also write the generated rows into the sqlite dictionary", default=None)
+    parser.add_argument("--dedup_index", help="the (word, code) index shared by the tables to remove duplicates", default=None)
+    parser.add_argument("--dedup_order", nargs='+', help="the tables by priority for --dedup_index", default=())
+    parser.add_argument("--show_duplicates", help="print the rows removed as duplicates by the index", default=None)
     parser.add_argument("input_file", nargs="?", help="the input file", default=None)
     args = parser.parse_args()
 
+    if args.profile:
+        profiling.enable(args.profile, args.cprofile, args.trace_memory)
+
     if args.compare_code:
         compare_code()
         sys.exit(0)
 
+    if args.show_duplicates:
+        for table, word, code, owner in get_duplicates(args.show_duplicates):
+            print("%s\t%s\t%s\t%s" % (table, word, code, owner))
+        sys.exit(0)
+
+    if args.validate:
+        word_files = [args.input_file] if args.input_file else sorted(glob.glob("words_*.txt"))
+        report = build_validation_report(word_files=word_files, tables=sorted(glob.glob("pinvin_*.dict.yaml")), jobs=args.jobs)
+        if args.validate == '-':
+            json.dump(report, sys.stdout, ensure_ascii=False, indent=1)
+        else:
+            with open(args.validate, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
+        sys.exit(0)
+
     if not args.show_inconsistent and not args.text:
         print(get_header(args.name, args.input_tables), file=sys.stdout)
 
+    db = None
+    if args.db:
+        from convert_to_chinese import DB
+        db = DB(args.db)
+
+    dedup = None
+    if args.dedup_index:
+        if not args.name:
+            sys.stderr.write("Error: --dedup_index requires --name\n")
+            sys.exit(-1)
+        dedup = DedupIndex(args.dedup_index, args.name, list(args.dedup_order))
+
     if args.chinese_code:
         char_codes = get_code_of_chars_in_list()
-        words_freq = get_frequency_from_file(PINYIN_SIMP_DICT)
-        print_word_codes(char_codes, words_freq)
+        words_freq = load_frequency_store(PINYIN_SIMP_DICT)
+        print_word_codes(char_codes, words_freq, db=db, dedup=dedup)
 
     if args.input_file:
         words = get_words_from_file(args.input_file)
-        word_codes = get_code_of_words(words)
         if args.exclude_pinyin_phrase:
             pinyin_phrases = get_pinyin_phrases()
             purge_inconsistent_phrases(pinyin_phrases)
-            for word in pinyin_phrases:
-                if word in word_codes:
-                    del word_codes[word]
-        words_freq = get_frequency_from_file(PINYIN_SIMP_EXT1_DICT)
-        print_word_codes(word_codes, words_freq, fluent=args.fluent)
+            words = [word for word in words if word not in pinyin_phrases]
+        words_freq = load_frequency_store(PINYIN_SIMP_EXT1_DICT)
+        print_code_of_words(words, words_freq, fluent=args.fluent, db=db, dedup=dedup, jobs=args.jobs)
     elif args.text:
         text = ""
         for line in open(args.text, 'r'):
             text += line
-        convert_text(text, args.userdict)
+        import lexicon
+        annotator = lexicon.PinvinAnnotator(lexicon.load_lexicon(args.lexicon))
+        segmenter = None
+        if args.segmenter == "jieba":
+            import jieba as segmenter
+        convert_text(text, args.userdict, annotator, segmenter)
     elif args.pinyin_phrase:
         pinyin_phrases = get_pinyin_phrases()
         if args.check_pinyin:
             purge_inconsistent_phrases(pinyin_phrases, strict = False)
-        words_freq = get_frequency_from_file(PINYIN_SIMP_EXT1_DICT)
-        print_word_codes(pinyin_phrases, words_freq, fluent=args.fluent)
+        words_freq = load_frequency_store(PINYIN_SIMP_EXT1_DICT)
+        print_word_codes(kSyllables.intern_phrases(pinyin_phrases), words_freq, fluent=args.fluent, db=db, dedup=dedup)
     elif args.show_inconsistent:
         type = args.show_inconsistent
         show_inconsistent_chars(type)
+
+    if db:
+        db.close()
+    if dedup:
+        dedup.close()
@@ -0,0 +1,186 @@
+import os
+import sys
+import argparse
+from collections import Counter, deque
+from multiprocessing import Pool
+
+# An Aho-Corasick automaton over a list of phrases. The nodes are kept in flat lists:
+# goto[node] is a dict of char -> node, fail[node] the failure link and output[node]
+# the lengths of the phrases ending at the node, including those of its failure links.
+class PhraseMatcher:
+    def __init__(self, phrases):
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [()]
+        self.max_len = 0
+        for phrase in phrases:
+            self.add(phrase)
+        self.build()
+
+    def add(self, phrase):
+        node = 0
+        for char in phrase:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.output.append(())
+            node = nxt
+        if len(phrase) not in self.output[node]:
+            self.output[node] = self.output[node] + (len(phrase),)
+        self.max_len = max(self.max_len, len(phrase))
+
+    # compute the failure links in breadth first order
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(char, 0)
+                if self.output[self.fail[nxt]]:
+                    self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    # yield (start, length) of every occurrence of the phrases in text
+    def iter_matches(self, text):
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length in output[node]:
+                yield i - length + 1, length
+
+    # count the occurrences of the phrases beginning before limit
+    def count(self, text, limit=None, counter=None):
+        if counter is None:
+            counter = Counter()
+        if limit is None:
+            limit = len(text)
+        for start, length in self.iter_matches(text):
+            if start < limit:
+                counter[text[start:start + length]] += 1
+        return counter
+
+# read phrases from files with the phrase as the first field of each line
+def get_phrases_from_files(files, min_length=2):
+    phrases = set()
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if parts and len(parts[0]) >= min_length:
+                    phrases.add(parts[0])
+    return sorted(phrases)
+
+# split a file into byte ranges of about equal size, aligned to characters by the readers
+def get_chunk_ranges(path, chunk_size):
+    size = os.path.getsize(path)
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+kMatcher = None
+
+def set_worker_matcher(matcher):
+    global kMatcher
+    kMatcher = matcher
+
+# move a byte position forward to the beginning of a utf-8 character
+def align_to_char(f, pos):
+    f.seek(pos)
+    for byte in f.read(3):
+        if (byte & 0xC0) != 0x80:
+            break
+        pos += 1
+    return pos
+
+# count the phrases of the chunk [start, end) of a corpus. The chunk is extended by the
+# next max_len - 1 characters, and only the matches beginning inside the chunk are counted,
+# so a phrase crossing the boundary is counted exactly once.
+def count_chunk(args):
+    path, start, end = args
+    with open(path, 'rb') as f:
+        start = align_to_char(f, start)
+        end = align_to_char(f, end)
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8', errors='replace')
+        overlap = f.read(4 * kMatcher.max_len).decode('utf-8', errors='ignore')
+    overlap = overlap[:max(0, kMatcher.max_len - 1)]
+    return kMatcher.count(text + overlap, limit=len(text))
+
+def count_file(matcher, path, jobs=1, chunk_size=1 << 24):
+    tasks = [(path, start, end) for start, end in get_chunk_ranges(path, chunk_size)]
+    counter = Counter()
+    if jobs > 1:
+        with Pool(jobs, initializer=set_worker_matcher, initargs=(matcher,)) as pool:
+            for partial in pool.imap_unordered(count_chunk, tasks):
+                counter.update(partial)
+    else:
+        set_worker_matcher(matcher)
+        for task in tasks:
+            counter.update(count_chunk(task))
+    return counter
+
+# split a count evenly over n readings, the remainder going to the first readings,
+# so that the counts of a word add up to the occurrences of the word
+def split_count(count, n):
+    share, remainder = divmod(count, n)
+    return [share + 1 if i < remainder else share for i in range(n)]
+
+# write the counts in the format read by convert_to_pinvin.FrequencyStore:
+# "word\tcode\tfreq" with the toneless code of every reading of the word. The corpus
+# does not tell the readings of a polyphonic word apart, so its count is split over them.
+# The words without any code are skipped.
+def write_frequency(counter, outfile=sys.stdout):
+    import convert_to_pinvin as cp
+    words = sorted(counter)
+    word_codes = cp.get_code_of_words(words)
+    for word in words:
+        codes = []
+        for pinyin_seq in word_codes[word]:
+            code = cp.kSyllables.get_toneless(pinyin_seq)
+            if code not in codes:
+                codes.append(code)
+        if not codes:
+            # a character of the word is missing from the code tables
+            print(word, "Not found, skipped", file=sys.stderr)
+            continue
+        for code, count in zip(codes, split_count(counter[word], len(codes))):
+            print("%s\t%s\t%i" % (word, code, count), file=outfile)
+
+# python count_phrases.py <corpus1> ... <corpusN>
+# --phrases <file1> ... <fileN>: the phrase lists to count, default STPhrases.txt and words_B.txt
+# --min_length <num>: skip the phrases shorter than <num>
+# --jobs <num>: count chunks of the corpora in parallel
+# --chunk_size <bytes>: the size of the chunks
+# --output <file>: the frequency file to write, default stdout
+def main():
+    parser = argparse.ArgumentParser(description="Count phrases in corpora and write a frequency table")
+    parser.add_argument("corpus", nargs="+", help="the corpus files")
+    parser.add_argument("--phrases", nargs="+", default=["STPhrases.txt", "words_B.txt"], help="the phrase lists")
+    parser.add_argument("--min_length", type=int, default=2, help="skip the phrases shorter than <num>")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="count chunks in parallel")
+    parser.add_argument("--chunk_size", type=int, default=1 << 24, help="the size of the chunks in bytes")
+    parser.add_argument("--output", default=None, help="the frequency file to write")
+    args = parser.parse_args()
+
+    matcher = PhraseMatcher(get_phrases_from_files(args.phrases, args.min_length))
+    counter = Counter()
+    for path in args.corpus:
+        counter.update(count_file(matcher, path, jobs=args.jobs, chunk_size=args.chunk_size))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            write_frequency(counter, f)
+    else:
+        write_frequency(counter)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import heapq
+import io
+import json
+import logging
+import sys
+import time
+from multiprocessing import Pool
+
+import profiling
+import convert_to_chinese as ct
+import convert_to_pinvin as cp
+import lexicon
+
+# Round-trip evaluation of a release: every line of a Chinese corpus is converted to pinvin
+# by convert_to_pinvin.convert_text, decoded back by convert_to_chinese.DAGViterbiSearcher,
+# and the han characters of the result are compared with those of the line. The corpus is
+# streamed in chunks to a process pool, and the accuracy is accumulated as the chunks return.
+#
+#   char accuracy: 1 - the edit distance of the han characters / the han characters of the corpus
+#   sentence accuracy: the lines whose han characters all come back
+
+# the han characters of a line, the only ones compared: punctuation is converted both ways
+# and latin text passes through unchanged
+def get_han(text):
+    return ''.join(char for char in text if lexicon.is_han(char))
+
+# the Levenshtein distance of two strings
+def get_edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+        previous = current
+    return previous[-1]
+
+# converts lines both ways, timing each direction
+class RoundTrip:
+    def __init__(self, annotator, segmenter, searcher):
+        self.annotator = annotator
+        self.segmenter = segmenter
+        self.searcher = searcher
+        self.seconds = {'encode': 0.0, 'decode': 0.0}
+
+    # (line, pinvin, decoded, han characters, errors)
+    def evaluate_line(self, line):
+        started = time.perf_counter()
+        out = io.StringIO()
+        cp.convert_text(line, annotator=self.annotator, segmenter=self.segmenter, outfile=out)
+        pinvin = out.getvalue().strip()
+        encoded = time.perf_counter()
+        decoded = ct.decode_line(pinvin, self.searcher)
+        self.seconds['encode'] += encoded - started
+        self.seconds['decode'] += time.perf_counter() - encoded
+        expected = get_han(line)
+        return line, pinvin, decoded, len(expected), get_edit_distance(expected, get_han(decoded))
+
+    # the results of a chunk of lines, and the seconds spent by each direction on them
+    def evaluate_chunk(self, lines):
+        self.seconds = {'encode': 0.0, 'decode': 0.0}
+        return [self.evaluate_line(line) for line in lines], self.seconds
+
+# accumulates the results of the chunks into the report, keeping the worst mismatches
+class Report:
+    def __init__(self, worst=20):
+        self.lines = 0
+        self.chars = 0
+        self.errors = 0
+        self.correct_lines = 0
+        self.seconds = {'encode': 0.0, 'decode': 0.0}
+        self.worst = []  # a min heap of (errors, order, line, pinvin, decoded) of the worst lines
+        self.max_worst = worst
+
+    def add(self, results, seconds):
+        for line, pinvin, decoded, chars, errors in results:
+            self.lines += 1
+            self.chars += chars
+            self.errors += errors
+            if errors == 0:
+                self.correct_lines += 1
+            elif self.max_worst > 0:
+                # the later of equal mismatches is dropped, so the worst lines are deterministic
+                item = (errors, -self.lines, line, pinvin, decoded)
+                if len(self.worst) < self.max_worst:
+                    heapq.heappush(self.worst, item)
+                elif item > self.worst[0]:
+                    heapq.heapreplace(self.worst, item)
+        for stage in seconds:
+            self.seconds[stage] += seconds[stage]
+
+    def get_char_accuracy(self):
+        return 1 - self.errors / self.chars if self.chars else 1.0
+
+    def get_sentence_accuracy(self):
+        return self.correct_lines / self.lines if self.lines else 1.0
+
+    # the report as a dict, with the throughput of each direction in han characters per second
+    # of worker time, and the overall one per second of wall time
+    def to_dict(self, elapsed):
+        stages = dict()
+        for stage, seconds in self.seconds.items():
+            stages[stage] = {"seconds": round(seconds, 6), "chars_per_second": round(self.chars / seconds, 1) if seconds else None}
+        worst = [{"line": line, "pinvin": pinvin, "decoded": decoded, "errors": errors}
+                 for errors, _, line, pinvin, decoded in sorted(self.worst, reverse=True)]
+        return {
+            "lines": self.lines,
+            "chars": self.chars,
+            "char_errors": self.errors,
+            "char_accuracy": round(self.get_char_accuracy(), 6),
+            "sentence_accuracy": round(self.get_sentence_accuracy(), 6),
+            "elapsed": round(elapsed, 6),
+            "chars_per_second": round(self.chars / elapsed, 1) if elapsed else None,
+            "stages": stages,
+            "worst": worst,
+        }
+
+# the round trip of each worker process, opening its own lexicon and dictionary
+kWorkerRoundTrip = None
+
+def get_round_trip(lexicon_path, dict_path, backend='sqlite'):
+    lex = lexicon.load_lexicon(lexicon_path)
+    annotator = lexicon.PinvinAnnotator(lex)
+    segmenter = lexicon.Segmenter(lex)
+    return RoundTrip(annotator, segmenter, ct.DAGViterbiSearcher(ct.open_dict(dict_path, backend)))
+
+def set_worker_round_trip(lexicon_path, dict_path, backend):
+    global kWorkerRoundTrip
+    kWorkerRoundTrip = get_round_trip(lexicon_path, dict_path, backend)
+
+def evaluate_worker_chunk(lines):
+    return kWorkerRoundTrip.evaluate_chunk(lines)
+
+# the non-empty lines of the corpus files in chunks, read lazily
+def get_corpus_chunks(paths, chunk_size):
+    chunk = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in ct.get_input_lines(f):
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+# evaluate the chunks with a round trip in this process, or with a pool of workers
+# each having their own, in order; returns the Report
+def evaluate(chunks, round_trip=None, pool=None, worst=20):
+    report = Report(worst)
+    results = pool.imap(evaluate_worker_chunk, chunks) if pool else map(round_trip.evaluate_chunk, chunks)
+    for chunk_results, seconds in results:
+        report.add(chunk_results, seconds)
+        logging.debug(f"Evaluated {report.lines} lines, char accuracy {report.get_char_accuracy():.4f}.")
+    return report
+
+# python evaluate.py --corpus <file1> ... <fileN> [--workers N] [--report report.json]
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Round-trip a Chinese corpus through pinvin and report the accuracy")
+    parser.add_argument("--corpus", nargs="+", required=True, help="the corpus files, one sentence per line")
+    parser.add_argument("--lexicon", default=lexicon.LEXICON_PATH, help="the compiled lexicon of the encoder")
+    parser.add_argument("--dict", default="txt/dict.db", help="the dictionary of the decoder")
+    parser.add_argument("--backend", choices=["sqlite", "mmap"], default="sqlite", help="the backend of the dictionary")
+    parser.add_argument("--workers", type=int, default=1, help="the number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=200, help="the lines sent to a worker at once")
+    parser.add_argument("--worst", type=int, default=20, help="the number of worst mismatches to report")
+    parser.add_argument("--report", default="-", help="the json report, '-' for stdout")
+    parser.add_argument("--profile", default=None, help="dump per-stage timings of this process as json at exit")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable(args.profile)
+
+    started = time.perf_counter()
+    chunks = get_corpus_chunks(args.corpus, args.chunk_size)
+    if args.workers > 1:
+        lexicon.load_lexicon(args.lexicon)  # rebuild a stale lexicon once, before the workers load it
+        with Pool(args.workers, initializer=set_worker_round_trip, initargs=(args.lexicon, args.dict, args.backend)) as pool:
+            report = evaluate(chunks, pool=pool, worst=args.worst)
+    else:
+        report = evaluate(chunks, get_round_trip(args.lexicon, args.dict, args.backend), worst=args.worst)
+    result = report.to_dict(time.perf_counter() - started)
+    logging.info(f"{result['lines']} lines: char accuracy {result['char_accuracy']:.4f}, "
+                 f"sentence accuracy {result['sentence_accuracy']:.4f}, {result['elapsed']:.1f}s")
+
+    if args.report == '-':
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=1)
+
+if __name__ == "__main__":
+    main()
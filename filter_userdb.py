@@ -1,12 +1,19 @@
-import re
+import os
 import sys
+import shutil
 import argparse
+import tempfile
+from multiprocessing import Pool
 
 def get_threshold(maxlength):
     if maxlength is None:
         return sys.maxsize
     return maxlength
 
+# the number of syllables in the code of a userdb line
+def get_code_length(line):
+    return len(line.split("\t")[0].split())
+
 # Read in a file line by line
 def filter_file(path, maxlength=None):
     threshold = get_threshold(maxlength)
@@ -14,11 +21,10 @@ def filter_file(path, maxlength=None):
     with open(path, "r") as f:
         for line in f:
             line = line.strip()
-            if re.match(r'#', line):
+            if line.startswith('#'):
                 print(line)
                 continue
-            codes = line.split("\t")[0].split()
-            n = len(codes)
+            n = get_code_length(line)
             if n not in words:
                 words[n] = []
             words[n].append(line)
@@ -30,15 +36,87 @@ def filter_file(path, maxlength=None):
         for line in words[n]:
             print(line)
 
+# split a file into byte ranges of about equal size for the shards
+def get_shard_ranges(path, shards):
+    size = os.path.getsize(path)
+    step = max(1, -(-size // max(1, shards)))
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [(0, 0)]
+
+# stream the lines beginning in [start, end) of the file into shard files under tmpdir:
+# one for the comments and one per code length, dropping the over-length entries at once
+def spill_shard(path, start, end, tmpdir, index, threshold):
+    comments = os.path.join(tmpdir, "%d.comments" % index)
+    buckets = dict()
+    with open(path, "rb") as f, open(comments, "w") as fc:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b"\n":
+                f.readline()  # the line belongs to the previous shard
+        pos = f.tell()
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            line = raw.decode("utf-8").strip()
+            if line.startswith('#'):
+                fc.write(line + "\n")
+                continue
+            n = get_code_length(line)
+            if n > threshold:
+                continue
+            if n not in buckets:
+                buckets[n] = open(os.path.join(tmpdir, "%d.%d" % (index, n)), "w")
+            buckets[n].write(line + "\n")
+    for fb in buckets.values():
+        fb.close()
+    return comments, {n: fb.name for n, fb in buckets.items()}
+
+def spill_shard_star(args):
+    return spill_shard(*args)
+
+# the streaming variant of filter_file, with flat memory: the entries are spilled to
+# per-length shard files which are concatenated in order at the end. With jobs > 1
+# the input is split into byte ranges which are filtered in parallel.
+def filter_file_streaming(path, maxlength=None, jobs=1, outfile=sys.stdout):
+    threshold = get_threshold(maxlength)
+    with tempfile.TemporaryDirectory(prefix="userdb.") as tmpdir:
+        ranges = get_shard_ranges(path, jobs)
+        tasks = [(path, start, end, tmpdir, i, threshold) for i, (start, end) in enumerate(ranges)]
+        if jobs > 1:
+            with Pool(jobs) as pool:
+                shards = pool.map(spill_shard_star, tasks)
+        else:
+            shards = [spill_shard_star(task) for task in tasks]
+
+        for comments, _ in shards:
+            with open(comments, "r") as f:
+                shutil.copyfileobj(f, outfile)
+        lengths = sorted(set(n for _, buckets in shards for n in buckets))
+        for n in lengths:
+            outfile.write("# %d words\n" % n)
+            for _, buckets in shards:
+                if n not in buckets:
+                    continue
+                with open(buckets[n], "r") as f:
+                    shutil.copyfileobj(f, outfile)
+
 # python filter_userdb.py [FILENAME]
 # --maxlength <NUM>: filter out words longer than <NUM>
+# --stream: spill the entries to temporary shard files instead of holding them in memory
+# --jobs <NUM>: filter <NUM> shards of the input in parallel, implies --stream
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", help="the file to filter")
     parser.add_argument("--maxlength", type=int, help="filter out words longer than <NUM>")
+    parser.add_argument("--stream", action="store_true", help="spill the entries to temporary shard files")
+    parser.add_argument("--jobs", type=int, default=1, help="filter <NUM> shards of the input in parallel")
 
     args = parser.parse_args()
-    filter_file(args.filename, maxlength=args.maxlength)
+    if args.stream or args.jobs > 1:
+        filter_file_streaming(args.filename, maxlength=args.maxlength, jobs=args.jobs)
+    else:
+        filter_file(args.filename, maxlength=args.maxlength)
 
 if __name__ == "__main__":
     main()
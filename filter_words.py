@@ -2,6 +2,12 @@ import os
 import re
 import sys
 import argparse
+import unicodedata
+from itertools import islice
+from multiprocessing import Pool
+
+kDeDiDer = re.compile(r'.+(?:地: .*de|得: .*de|的: .*di)\s*$')
+kWordSep = re.compile(r'[\s:]')
 
 # print only the words of a given length from a file
 def filter_by_length(file, length):
@@ -16,25 +22,138 @@ def filter_dedider(file):
     with open(file) as f:
         for line in f:
             line = line.strip()
-            if re.match(r'.+地: .*de\s*$', line) or re.match(r'.+得: .*de\s*$', line) or re.match(r'.+的: .*di\s*$', line):
+            if kDeDiDer.match(line):
                 continue
             print(line)
 
+# the word of a line in the format "WORD", "WORD freq ..." or "WORD: py1 py2 ... pyN"
+def get_word(line):
+    return kWordSep.split(line, 1)[0]
+
+# A pipeline of filters applied to every line in a single pass. Each stage takes a
+# stripped line and returns the line, maybe normalized, or None to drop it. The
+# deduplication is global, so it runs in the parent after the parallel stages.
+class Pipeline:
+    def __init__(self, normalize=False, length=0, min_length=0, max_length=0,
+                 filter_dedider=False, coverage=False, dedupe=False):
+        self.stages = []
+        if normalize:
+            self.stages.append(self.normalize)
+        if length or min_length or max_length:
+            self.min_length = length or min_length
+            self.max_length = length or max_length or sys.maxsize
+            self.stages.append(self.filter_length)
+        if filter_dedider:
+            self.stages.append(self.filter_dedider)
+        if coverage:
+            self.char_codes = None
+            self.stages.append(self.filter_coverage)
+        self.dedupe = dedupe
+
+    def normalize(self, line):
+        return unicodedata.normalize('NFC', ' '.join(line.split()))
+
+    def filter_length(self, line):
+        n = len(get_word(line))
+        if n < self.min_length or n > self.max_length:
+            return None
+        return line
+
+    def filter_dedider(self, line):
+        return None if kDeDiDer.match(line) else line
+
+    # drop the words with any character not found in the code tables
+    def filter_coverage(self, line):
+        if self.char_codes is None:
+            from convert_to_pinvin import get_pinyin_code_of_chars
+            self.char_codes = get_pinyin_code_of_chars(reviseDe = True)
+        for char in get_word(line):
+            if char not in self.char_codes:
+                return None
+        return line
+
+    def process(self, lines):
+        result = []
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            for stage in self.stages:
+                line = stage(line)
+                if line is None:
+                    break
+            if line is not None:
+                result.append(line)
+        return result
+
+    # run the pipeline over the lines of a file, in chunks of parallel workers if jobs > 1
+    def run(self, file, jobs=1, chunk_size=10000, outfile=sys.stdout):
+        seen = set()
+        if self.filter_coverage in self.stages:
+            self.filter_coverage('')  # load the code tables once, before forking the workers
+        with open(file) as f:
+            chunks = iter(lambda: list(islice(f, chunk_size)), [])
+            if jobs > 1:
+                pool = Pool(jobs, initializer=set_worker_pipeline, initargs=(self,))
+                results = pool.imap(process_chunk, chunks)
+            else:
+                pool = None
+                results = map(self.process, chunks)
+            for lines in results:
+                for line in lines:
+                    if self.dedupe:
+                        word = get_word(line)
+                        if word in seen:
+                            continue
+                        seen.add(word)
+                    outfile.write(line + '\n')
+            if pool:
+                pool.close()
+                pool.join()
+
+kWorkerPipeline = None
+
+def set_worker_pipeline(pipeline):
+    global kWorkerPipeline
+    kWorkerPipeline = pipeline
+
+def process_chunk(lines):
+    return kWorkerPipeline.process(lines)
+
 if __name__ == '__main__':
     # Handle command line arguments with argparse
     # python filter_words.py <file>
     # --length <length>: print only the words of the given length
     # --filter_dedider: filter the words ending '地' and '得' characters
+    # --pipeline: apply the following filters in a single pass over the first word of each line
+    #   --dedupe: print only the first line of each word
+    #   --length, --min_length, --max_length <length>: filter the words by length
+    #   --filter_dedider: filter the '地', '得' and '的' readings as above
+    #   --coverage: filter the words with characters not found in the code tables
+    #   --normalize: normalize the lines to NFC with single spaces
+    #   --jobs <num>: process chunks of the file in parallel workers
     parser = argparse.ArgumentParser(description='Print words of a given length from a file')
     parser.add_argument('file', type=str, help='The file to read words from')
     parser.add_argument('--length', type=int, help='The length of the words to print', default=0)
     parser.add_argument('--filter_dedider', action='store_true', help='Filter the words ending in "地" and "得" characters')
+    parser.add_argument('--pipeline', action='store_true', help='Apply all the given filters in a single pass')
+    parser.add_argument('--dedupe', action='store_true', help='Print only the first line of each word')
+    parser.add_argument('--min_length', type=int, help='The minimal length of the words to print', default=0)
+    parser.add_argument('--max_length', type=int, help='The maximal length of the words to print', default=0)
+    parser.add_argument('--coverage', action='store_true', help='Filter the words with characters not in the code tables')
+    parser.add_argument('--normalize', action='store_true', help='Normalize the lines to NFC with single spaces')
+    parser.add_argument('--jobs', type=int, help='The number of parallel workers', default=1)
     args = parser.parse_args()
 
-    if args.length:
+    if args.pipeline:
+        pipeline = Pipeline(normalize=args.normalize, length=args.length, min_length=args.min_length,
+                            max_length=args.max_length, filter_dedider=args.filter_dedider,
+                            coverage=args.coverage, dedupe=args.dedupe)
+        pipeline.run(args.file, jobs=args.jobs)
+    elif args.length:
         filter_by_length(args.file, args.length)
     elif args.filter_dedider:
         filter_dedider(args.file)
     else:
         parser.print_help()
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
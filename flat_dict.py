@@ -0,0 +1,239 @@
+import argparse
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# A read-only dictionary of pinyin -> [(word, freq)] in one flat buffer, which can be
+# shared by several decoder processes without copying, either in shared memory or as a
+# memory-mapped file. The layout, in native byte order:
+#
+#   header          MAGIC, version, key count, entry count, total_freq
+#   key_offsets     uint32[keys + 1]     offsets of the keys in key_blob
+#   entry_starts    uint32[keys + 1]     the entries of key i are [entry_starts[i], entry_starts[i + 1])
+#   best            uint32[keys]         the entry of the most frequent word of key i, the first on ties
+#   word_offsets    uint32[entries + 1]  offsets of the words in word_blob
+#   freqs           int64[entries]
+#   key_blob        the utf-8 keys, sorted bytewise as sqlite does
+#   word_blob       the utf-8 words
+#
+# The entries of a key are ordered by frequency then word, as convert_to_chinese.DB
+# returns them, so ties of frequencies are broken the same way.
+
+MAGIC = b'PVFD'
+VERSION = 2
+kHeader = struct.Struct('=4sIIIq')
+
+# collect (pinyin, word, freq) sorted by pinyin into a flat buffer
+def build_flat_dict(entries, total_freq):
+    keys = []
+    key_offsets = array('I', [0])
+    entry_starts = array('I', [0])
+    best = array('I')
+    word_offsets = array('I', [0])
+    freqs = array('q')
+    key_blob = bytearray()
+    word_blob = bytearray()
+    for pinyin, word, freq in entries:
+        key = pinyin.encode('utf-8')
+        if not keys or keys[-1] != key:
+            if keys:
+                entry_starts.append(len(freqs))
+            keys.append(key)
+            key_blob += key
+            key_offsets.append(len(key_blob))
+            best.append(len(freqs))
+        elif freq > freqs[best[-1]]:
+            best[-1] = len(freqs)
+        word_blob += word.encode('utf-8')
+        word_offsets.append(len(word_blob))
+        freqs.append(freq)
+    if keys:
+        entry_starts.append(len(freqs))
+
+    header = kHeader.pack(MAGIC, VERSION, len(keys), len(freqs), total_freq)
+    return b''.join([header, key_offsets.tobytes(), entry_starts.tobytes(), best.tobytes(),
+                     word_offsets.tobytes(), freqs.tobytes(), bytes(key_blob), bytes(word_blob)])
+
+# build the flat buffer of a convert_to_chinese.DB, with its overlays resolved
+def build_flat_dict_from_db(db):
+    return build_flat_dict(db.iter_entries(), db.get_total_freq())
+
+# compile a sqlite dictionary, or rime tables (.dict.yaml) imported as by
+# convert_to_chinese.py --import_tables, into a flat dictionary file
+def compile_flat_dict(output, db_path=None, tables=None):
+    from convert_to_chinese import DB
+    db = DB(db_path if db_path else ':memory:')
+    try:
+        if tables:
+            db.import_tables(tables)
+        data = build_flat_dict_from_db(db)
+    finally:
+        db.close()
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, output)
+    logging.debug(f"Compiled the flat dictionary {output} of {len(data)} bytes.")
+    return len(data)
+
+# A zero-copy reader of a flat buffer with the lookup interface of convert_to_chinese.DB
+class FlatDict:
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        magic, version, n_keys, n_entries, self.total_freq = kHeader.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a flat dictionary of version %d" % VERSION)
+        self.n_keys = n_keys
+        self.n_entries = n_entries
+        pos = kHeader.size
+        self.key_offsets, pos = self.get_array(pos, 'I', n_keys + 1)
+        self.entry_starts, pos = self.get_array(pos, 'I', n_keys + 1)
+        self.best, pos = self.get_array(pos, 'I', n_keys)
+        self.word_offsets, pos = self.get_array(pos, 'I', n_entries + 1)
+        self.freqs, pos = self.get_array(pos, 'q', n_entries)
+        self.key_blob = self.buffer[pos:pos + self.key_offsets[n_keys]]
+        pos += self.key_offsets[n_keys]
+        self.word_blob = self.buffer[pos:pos + self.word_offsets[n_entries]]
+        self.metrics = None
+
+    def get_array(self, pos, format, count):
+        size = struct.calcsize(format) * count
+        return self.buffer[pos:pos + size].cast(format), pos + size
+
+    def get_key(self, i):
+        return bytes(self.key_blob[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    # the index of the first key not less than a utf-8 key
+    def lower_bound(self, key):
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # the index of a utf-8 key, or -1
+    def find(self, key):
+        i = self.lower_bound(key)
+        if i < self.n_keys and self.get_key(i) == key:
+            return i
+        return -1
+
+    def get_word(self, e):
+        return str(self.word_blob[self.word_offsets[e]:self.word_offsets[e + 1]], 'utf-8')
+
+    def get_entries(self, i):
+        return [(self.get_word(e), self.freqs[e]) for e in range(self.entry_starts[i], self.entry_starts[i + 1])]
+
+    def get_word_freq(self, pinyin):
+        i = self.find(pinyin.encode('utf-8'))
+        return self.get_entries(i) if i >= 0 else []
+
+    # the (word, freq, logp) of the precomputed most frequent word of pinyin, or None
+    def get_best(self, pinyin):
+        i = self.find(pinyin.encode('utf-8'))
+        if i < 0:
+            return None
+        e = self.best[i]
+        freq = self.freqs[e]
+        return (self.get_word(e), freq, math.log((freq + 1) / self.total_freq))
+
+    # the keys beginning with prefix, in sorted order
+    def iter_prefix(self, prefix):
+        key = prefix.encode('utf-8')
+        for i in range(self.lower_bound(key), self.n_keys):
+            k = self.get_key(i)
+            if not k.startswith(key):
+                break
+            yield str(k, 'utf-8')
+
+    # nothing to prefetch, all the entries are in memory
+    def prefetch_word_freq(self, pinyin_list):
+        pass
+
+    def get_total_freq(self):
+        return self.total_freq
+
+    # the length of the longest key, the keys being ascii pinyin
+    def get_max_pinyin_len(self):
+        offsets = self.key_offsets
+        return max((offsets[i + 1] - offsets[i] for i in range(self.n_keys)), default=1)
+
+    def get_dict_version(self):
+        return "flat:%d:%d" % (self.n_entries, self.total_freq)
+
+    # release the views of the buffer, so that it may be closed by its owner
+    def close(self):
+        for name in ('key_offsets', 'entry_starts', 'best', 'word_offsets', 'freqs', 'key_blob', 'word_blob'):
+            getattr(self, name).release()
+        self.buffer.release()
+
+# A FlatDict in a multiprocessing.shared_memory segment: created once by the parent from
+# a DB, then attached by name in the workers, which share one copy of the dictionary.
+class SharedFlatDict(FlatDict):
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        super().__init__(shm.buf)
+
+    @classmethod
+    def create(cls, db):
+        from multiprocessing import shared_memory
+        data = build_flat_dict_from_db(db)
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        logging.debug(f"Exported the dictionary into shared memory {shm.name} of {len(data)} bytes.")
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        from multiprocessing import shared_memory
+        # the workers share the resource tracker of the parent, which unlinks the segment at close
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        super().close()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# A FlatDict of a compiled file, memory-mapped read-only: it opens without parsing,
+# and the pages are shared through the page cache by all the processes mapping it
+class MmapFlatDict(FlatDict):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(self.mmap)
+
+    def close(self):
+        super().close()
+        self.mmap.close()
+        self.file.close()
+
+# python flat_dict.py --output <file> (--db <dict.db> | --tables <table1> ... <tableN>)
+def main():
+    parser = argparse.ArgumentParser(description="Compile a flat dictionary file for convert_to_chinese.py --backend mmap")
+    parser.add_argument("--output", default="txt/dict.flat", help="the flat dictionary file to write")
+    parser.add_argument("--db", default=None, help="the sqlite dictionary to compile")
+    parser.add_argument("--tables", nargs="+", default=None, help="the rime tables (.dict.yaml) to compile")
+    args = parser.parse_args()
+    if not args.db and not args.tables:
+        parser.print_help()
+        sys.exit(1)
+    size = compile_flat_dict(args.output, db_path=args.db, tables=args.tables)
+    print("Ok, %s compiled, %d bytes" % (args.output, size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import glob
+import logging
+import math
+import os
+import pickle
+import re
+import unicodedata
+
+import profiling
+from convert_to_chinese import get_rows_from_table
+
+# a lexicon compiled from our own tables: the reading and the frequency of each word,
+# shared by the annotator and the segmenter of convert_to_pinvin.convert_text
+
+LEXICON_PATH = "txt/lexicon.pickle"
+LEXICON_VERSION = 2
+TABLE_PATTERN = "pinvin_*.dict.yaml"
+WORDS_PATTERN = "words_*.txt"
+
+# the pinvin syllables never begin with 'v' unless prefixed, see get_prepended_v_seqs
+def strip_v(syllable):
+    if len(syllable) > 1 and syllable[0] == 'v':
+        return syllable[1:]
+    return syllable
+
+def get_default_tables():
+    return sorted(glob.glob(TABLE_PATTERN))
+
+def get_default_word_files():
+    return sorted(glob.glob(WORDS_PATTERN))
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+class Lexicon:
+    def __init__(self):
+        self.readings = dict()  # word -> pinvin syllables without 'v' prefixes, separated by spaces
+        self.freqs = dict()     # word -> frequency
+        self.max_word_len = 1
+        self.total = 0          # the sum of frequencies, counting 0 as 1
+        self.sources = []       # [(path, mtime)] the lexicon was built from
+
+    # build from the generated tables, the curated phrases and the character codes.
+    # Readings of phrases come from pinyin_phrase.txt at first, then the table code with
+    # the highest frequency; readings of characters are chosen among the codes of
+    # get_pinyin_code_of_chars(reviseDe=True) by their frequency in the tables.
+    @classmethod
+    def build(cls, tables=None, phrase_file=None, word_files=None):
+        import convert_to_pinvin as cp
+        if tables is None:
+            tables = get_default_tables()
+        if word_files is None:
+            word_files = get_default_word_files()
+        if phrase_file is None:
+            phrase_file = cp.PINYIN_PHRASE
+
+        lexicon = cls()
+        char_freq = dict()  # (char, syllable) -> frequency
+        candidates = dict() # word -> [(freq, syllables)]
+        for path in tables:
+            with open(path, 'r', encoding='utf-8') as f:
+                for word, code, freq in get_rows_from_table(f):
+                    syllables = code.split(' ')
+                    if len(syllables) != len(word) or syllables[0][0] == 'v':
+                        continue
+                    syllables = ' '.join([syllables[0]] + [strip_v(s) for s in syllables[1:]])
+                    if len(word) == 1:
+                        key = (word, syllables)
+                        char_freq[key] = max(freq, char_freq.get(key, 0))
+                    if word not in candidates:
+                        candidates[word] = []
+                    candidates[word].append((freq, syllables))
+            lexicon.sources.append((path, get_mtime(path)))
+
+        for word, cands in candidates.items():
+            best = None
+            for freq, syllables in cands:
+                score = (freq, sum(char_freq.get(key, 0) for key in zip(word, syllables.split(' '))))
+                if best is None or score > best[0]:
+                    best = (score, syllables)
+            lexicon.readings[word] = best[1]
+            lexicon.freqs[word] = best[0][0]
+
+        # ties of tonal variants sharing a toneless frequency go to the order of pinyin.txt
+        char_codes = cp.get_pinyin_code_of_chars(reviseDe=True)
+        for char, codes in char_codes.items():
+            common = cp.kPinyinCodes.get(char, [])
+            best = None
+            for pinyin in codes:
+                syllable = cp.get_pinvin(pinyin)
+                rank = common.index(pinyin) if pinyin in common else len(common)
+                score = (char_freq.get((char, syllable), 0), -rank)
+                if best is None or score > best[0]:
+                    best = (score, syllable)
+            if best:
+                lexicon.readings[char] = best[1]
+                lexicon.freqs.setdefault(char, 0)
+        lexicon.sources.append((cp.PINYIN_CODE, get_mtime(cp.PINYIN_CODE)))
+        lexicon.sources.append((cp.STANDARD_CHINESE, get_mtime(cp.STANDARD_CHINESE)))
+
+        if os.path.exists(phrase_file):
+            phrases = cp.get_pinyin_phrase_from_file(phrase_file)
+            for word, pinyin_seqs in phrases.items():
+                if len(pinyin_seqs[0]) != len(word):
+                    continue
+                lexicon.readings[word] = ' '.join(cp.get_pinvin(py) for py in pinyin_seqs[0])
+                lexicon.freqs.setdefault(word, 0)
+            lexicon.sources.append((phrase_file, get_mtime(phrase_file)))
+
+        for path in word_files:
+            for word in cp.get_words_from_file(path):
+                if word:
+                    lexicon.freqs.setdefault(word, 0)
+            lexicon.sources.append((path, get_mtime(path)))
+        lexicon.update_total()
+        logging.debug(f"Built lexicon of {len(lexicon.readings)} readings from {len(lexicon.sources)} sources.")
+        return lexicon
+
+    # recompute the total frequency and the maximal word length for the segmenter
+    def update_total(self):
+        self.total = sum(max(freq, 1) for freq in self.freqs.values())
+        self.max_word_len = max(map(len, self.freqs), default=1)
+
+    def add_word(self, word, freq):
+        if word not in self.freqs:
+            self.total += max(freq, 1)
+        else:
+            self.total += max(freq, 1) - max(self.freqs[word], 1)
+        self.freqs[word] = freq
+        self.max_word_len = max(self.max_word_len, len(word))
+
+    def is_stale(self):
+        return any(get_mtime(path) != mtime for path, mtime in self.sources)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        data = {"version": LEXICON_VERSION, "readings": self.readings, "freqs": self.freqs,
+                "max_word_len": self.max_word_len, "total": self.total, "sources": self.sources}
+        # written aside and renamed, so that a reader, or another process building the
+        # lexicon at the same time, never sees a partial file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    # load a compiled lexicon, or return None if it is unreadable or of another version
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get("version") != LEXICON_VERSION:
+                return None
+            lexicon = cls()
+            lexicon.readings = data["readings"]
+            lexicon.freqs = data["freqs"]
+            lexicon.max_word_len = data["max_word_len"]
+            lexicon.total = data["total"]
+            lexicon.sources = data["sources"]
+            return lexicon
+        except Exception as e:
+            logging.warning(f"Rebuilding the lexicon {path}: {e}")
+            return None
+
+# load the compiled lexicon from path, or (re)build and save it when missing or stale
+def load_lexicon(path=LEXICON_PATH, tables=None):
+    lexicon = None
+    if os.path.exists(path):
+        lexicon = Lexicon.load(path)
+        if lexicon and tables is not None and sorted(tables) != sorted(p for p, m in lexicon.sources if p.endswith('.dict.yaml')):
+            lexicon = None
+        if lexicon and lexicon.is_stale():
+            lexicon = None
+    if lexicon is None:
+        lexicon = Lexicon.build(tables)
+        lexicon.save(path)
+    return lexicon
+
+def is_han(char):
+    return ord(char) >= 0x2E80 and unicodedata.category(char) == 'Lo'
+
+# annotate words with pinvin from the lexicon, with per-character readings as the fallback
+# and pypinyin as the last resort for characters missing in our tables
+class PinvinAnnotator:
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        self.cache = dict()
+        self.pypinyin = None
+
+    # return a new list of pinvin syllables of word, e.g. ['nyi', 'hau']
+    def annotate(self, word):
+        if word in self.cache:
+            profiling.count('annotate.hit')
+            return list(self.cache[word])
+        profiling.count('annotate.miss')
+        readings = self.lexicon.readings
+        if word in readings:
+            syllables = readings[word].split(' ')
+            literal = [False] * len(syllables)
+        else:
+            syllables = []
+            literal = []  # whether the element is copied verbatim from word
+            for char in word:
+                if char in readings:
+                    syllables.append(readings[char])
+                    literal.append(False)
+                elif is_han(char):
+                    syllables.append(self.fallback(char))
+                    literal.append(False)
+                elif literal and literal[-1]:
+                    syllables[-1] += char
+                else:
+                    syllables.append(char)
+                    literal.append(True)
+        pvs = []
+        for i, syllable in enumerate(syllables):
+            if i > 0 and not literal[i] and syllable[0] in 'aoeiuyw':
+                syllable = 'v' + syllable
+            pvs.append(syllable)
+        self.cache[word] = tuple(pvs)
+        return pvs
+
+    # the pinvin of a character from pypinyin, or the character itself
+    def fallback(self, char):
+        if self.pypinyin is None:
+            try:
+                from pypinyin import pinyin, Style
+                self.pypinyin = lambda c: pinyin(c, style=Style.TONE, strict=False)[0][0]
+            except ImportError:
+                self.pypinyin = lambda c: c
+        profiling.count('annotate.pypinyin')
+        import convert_to_pinvin as cp
+        return cp.get_pinvin(self.pypinyin(char))
+
+kHanBlock = re.compile(r"([\u2E80-\u9FFF\uF900-\uFAFF\U00020000-\U0003FFFFa-zA-Z0-9+#&\._%\-]+)")
+kSkip = re.compile(r"(\r\n|\s)")
+kAlnum = re.compile(r"[a-zA-Z0-9]")
+
+# a maximum probability segmenter over the words of a lexicon, which
+# builds a DAG of the words and routes it like DAGViterbiSearcher. It is a drop-in
+# replacement of jieba for convert_text, with lcut and load_userdict.
+class Segmenter:
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+
+    # all ends (exclusive) of the words beginning at each position of sentence
+    def get_dag(self, sentence):
+        freqs = self.lexicon.freqs
+        max_len = self.lexicon.max_word_len
+        N = len(sentence)
+        dag = dict()
+        for k in range(N):
+            ends = [i for i in range(k + 1, min(N, k + max_len) + 1) if sentence[k:i] in freqs]
+            if not ends:
+                ends.append(k + 1)
+            dag[k] = ends
+        return dag
+
+    def calc_route(self, sentence, dag):
+        freqs = self.lexicon.freqs
+        log_total = math.log(self.lexicon.total)
+        N = len(sentence)
+        route = {N: (0, 0)}
+        for i in range(N - 1, -1, -1):
+            route[i] = max((math.log(freqs.get(sentence[i:j]) or 1) - log_total + route[j][0], j) for j in dag[i])
+        return route
+
+    # cut a block of han characters, grouping the single latin letters and digits
+    def cut_block(self, sentence):
+        with profiling.stage('segment.route'):
+            route = self.calc_route(sentence, self.get_dag(sentence))
+        i = 0
+        N = len(sentence)
+        buf = ''
+        while i < N:
+            j = route[i][1]
+            word = sentence[i:j]
+            if j - i == 1 and kAlnum.match(word):
+                buf += word
+            else:
+                if buf:
+                    yield buf
+                    buf = ''
+                yield word
+            i = j
+        if buf:
+            yield buf
+
+    def cut(self, text):
+        for block in kHanBlock.split(text):
+            if not block:
+                continue
+            if kHanBlock.match(block):
+                yield from self.cut_block(block)
+                continue
+            for x in kSkip.split(block):
+                if kSkip.match(x):
+                    yield x
+                else:
+                    yield from x
+
+    def lcut(self, text):
+        return list(self.cut(text))
+
+    # the frequency which makes word to be cut as a whole
+    def suggest_freq(self, word):
+        total = self.lexicon.total
+        freqs = self.lexicon.freqs
+        freq = 1.0
+        for seg in self.cut_block(word):
+            freq *= (freqs.get(seg) or 1) / total
+        return max(int(freq * total) + 1, freqs.get(word, 0))
+
+    # load a user dictionary in the jieba format: "word [freq] [tag]"
+    def load_userdict(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.strip().split()
+                if not parts:
+                    continue
+                word = parts[0]
+                if len(parts) > 1 and parts[1].isdigit():
+                    freq = int(parts[1])
+                else:
+                    freq = self.suggest_freq(word)
+                self.lexicon.add_word(word, freq)
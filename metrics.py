@@ -0,0 +1,186 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default latency buckets in seconds, following the prometheus client defaults
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PREFETCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    kind = 'gauge'
+
+    # a gauge is either set explicitly, or computed by func at scrape time
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.func() if self.func else self.value
+        return [(self.name, value)]
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            samples.append((f'{self.name}_bucket{{le="{format_value(float(bound))}"}}', cumulative))
+        samples.append((self.name + '_sum', total))
+        samples.append((self.name + '_count', cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, func=None):
+        return self.register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    # render all metrics in the prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    # write the metrics atomically, e.g. for the node exporter textfile collector
+    def write_file(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    # serve the metrics over http on /metrics from a daemon thread
+    def serve(self, port, host='127.0.0.1'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        logging.info(f"Serving metrics on http://{host}:{self.server.server_port}/metrics")
+        return self.server
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+# the metrics of a dictionary and its decoders, shared by DB and DAGViterbiSearcher.
+# The throughput is left to the queries over a window, e.g.
+#   rate(pinvin_tokens_decoded_total[5m]) / rate(pinvin_decode_seconds_total[5m])
+class DecoderMetrics:
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        r = self.registry
+        self.lines_decoded = r.counter('pinvin_lines_decoded_total', 'Lines decoded by the searcher.')
+        self.tokens_decoded = r.counter('pinvin_tokens_decoded_total', 'Pinyin tokens decoded by the searcher.')
+        self.decode_seconds = r.counter('pinvin_decode_seconds_total', 'Seconds spent decoding lines.')
+        self.word_freq_hits = r.counter('pinvin_word_freq_cache_hits_total', 'get_word_freq lookups answered by the cache.')
+        self.word_freq_misses = r.counter('pinvin_word_freq_cache_misses_total', 'get_word_freq lookups sent to the database.')
+        self.prefetch_batch_size = r.histogram('pinvin_prefetch_batch_size', 'Number of pinyins per prefetch query.',
+                                               buckets=PREFETCH_BUCKETS)
+        self.sql_latency = r.histogram('pinvin_sql_latency_seconds', 'Latency of dictionary sql queries.')
+        self.unknown_spans = r.counter('pinvin_unknown_span_fallbacks_total', 'Unmatched spans sent to the deep search.')
+        # the tier which answered each budgeted search, see convert_to_chinese.Budget
+        self.tiers = {tier: r.counter('pinvin_search_%s_total' % tier, 'Budgeted searches answered by the %s tier.' % tier)
+                      for tier in ('viterbi', 'greedy', 'passthrough')}
+        self.cache_size = None
+
+    # report the number of cached pinyins of db at scrape time
+    def track_cache(self, db):
+        self.cache_size = self.registry.gauge('pinvin_word_freq_cache_size', 'Pinyins held in the word frequency cache.',
+                                              func=lambda: len(db.pinyin_to_best) + len(db.pinyin_to_words))
+
+    def observe_tier(self, tier):
+        self.tiers[tier].inc()
+
+    def observe_line(self, tokens, started):
+        self.lines_decoded.inc()
+        self.tokens_decoded.inc(tokens)
+        self.decode_seconds.inc(time.perf_counter() - started)
@@ -0,0 +1,159 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+# the profiler of the current run, None when profiling is disabled.
+# Instrumented code only pays one global lookup per call when disabled.
+active = None
+
+# Stages are timed exclusively: the time of a nested stage is taken off its parent, so
+# the seconds of all stages add up to at most the elapsed time. The inclusive time
+# counts a stage re-entered while active (e.g. search -> deep_search -> search) once.
+# Tracing the peak memory slows every allocation, so it is off unless asked for.
+class Profiler:
+    def __init__(self, cprofile_path=None, trace_memory=False):
+        self.stages = defaultdict(lambda: [0.0, 0, 0.0])  # name -> [exclusive seconds, calls, inclusive seconds]
+        self.local = threading.local()  # the running stages of each thread
+        self.counters = defaultdict(int)
+        self.cprofile_path = cprofile_path
+        self.trace_memory = trace_memory
+        self.cprofiler = None
+        self.started = 0.0
+        self.elapsed = 0.0
+        self.peak_memory = None
+
+    @property
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        else:
+            self.trace_memory = False
+        if self.cprofile_path:
+            self.cprofiler = cProfile.Profile()
+            self.cprofiler.enable()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self.cprofiler:
+            self.cprofiler.disable()
+            self.cprofiler.dump_stats(self.cprofile_path)
+            self.cprofiler = None
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    # the report as a json-serializable dictionary, hit rates are derived
+    # from counter pairs named "<name>.hit" and "<name>.miss"
+    def report(self):
+        stages = dict()
+        for name in sorted(self.stages):
+            seconds, calls, inclusive = self.stages[name]
+            stages[name] = {"seconds": round(seconds, 6), "inclusive": round(inclusive, 6), "calls": calls}
+        hit_rates = dict()
+        for name in sorted(self.counters):
+            if not name.endswith('.hit'):
+                continue
+            prefix = name[:-len('.hit')]
+            hits = self.counters[name]
+            total = hits + self.counters.get(prefix + '.miss', 0)
+            hit_rates[prefix] = round(hits / total, 6) if total else 0.0
+        return {
+            "elapsed": round(self.elapsed, 6),
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "hit_rates": hit_rates,
+            "peak_memory": self.peak_memory,
+        }
+
+    def dump(self, path):
+        report = self.report()
+        if path == '-':
+            json.dump(report, sys.stderr, indent=2)
+            sys.stderr.write('\n')
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logging.debug(f"Profile written to {path}.")
+
+# time a stage, accumulating the seconds and the number of calls by name
+class Stage:
+    __slots__ = ('profiler', 'name', 'started', 'children')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.profiler.stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        stack = self.profiler.stack
+        stack.pop()
+        record = self.profiler.stages[self.name]
+        record[0] += seconds - self.children
+        record[1] += 1
+        if not any(outer.name == self.name for outer in stack):
+            record[2] += seconds
+        if stack:
+            stack[-1].children += seconds
+        return False
+
+kNullStage = contextlib.nullcontext()
+
+def stage(name):
+    if active is None:
+        return kNullStage
+    return Stage(active, name)
+
+def count(name, n=1):
+    if active is not None:
+        active.counters[name] += n
+
+# profile the body of a with statement, and dump the json report to path if given
+@contextlib.contextmanager
+def profile(path=None, cprofile_path=None, trace_memory=False):
+    global active
+    previous = active
+    profiler = Profiler(cprofile_path, trace_memory)
+    active = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        active = previous
+        if path:
+            profiler.dump(path)
+
+# enable profiling for the rest of the process, the report is dumped at exit
+def enable(path, cprofile_path=None, trace_memory=False):
+    global active
+    profiler = Profiler(cprofile_path, trace_memory)
+    active = profiler
+    profiler.start()
+
+    def finish():
+        global active
+        profiler.stop()
+        active = None
+        profiler.dump(path)
+    atexit.register(finish)
+    return profiler
@@ -2,8 +2,20 @@
 
 import unittest
 import convert_to_chinese as ct
+import count_phrases
+import convert_to_pinvin as cp
+import lexicon
+import filter_userdb
+import filter_words
+import profiling
+from metrics import DecoderMetrics
 import logging
+import math
+import os
 import sys
+import tempfile
+import io
+from contextlib import redirect_stdout, redirect_stderr
 
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,6 +33,9 @@ class TestConvertToChinese(unittest.TestCase):
         testcases = [
             ("uoo zay jiam, Lucy!", ["uoo", "zay", "jiam", "，",  "Lucy", "！"]),
             ("uoo zay jiam, Lucy! xieh xieh!", ["uoo", "zay", "jiam", "，", "Lucy", "！" ,"xieh", "xieh", "！"]),
+            ("  nyi\u3000hau《a+b》\n", ["nyi", "hau", "《", "a+b", "》"]),
+            ("hau\U0001039fnyi \U0001F600!", ["hau", "\U0001039f", "nyi", "\U0001F600", "！"]),
+            ("", []),
         ]
 
         for pinyin_str, expected_result in testcases:
@@ -28,6 +43,15 @@ class TestConvertToChinese(unittest.TestCase):
                 result = ct.split_pinyin_and_punct(pinyin_str)
                 self.assertEqual(result, expected_result)
 
+    def test_iter_tokens(self):
+        text = "nyi hau,  Lucy\U0001039f!"
+        tokens = list(ct.iter_tokens(text))
+        self.assertEqual(tokens, [("nyi", 0, 3), ("hau", 4, 7), ("，", 7, 8), ("Lucy", 10, 14),
+                                  ("\U0001039f", 14, 15), ("！", 15, 16)])
+        for token, start, end in tokens:
+            with self.subTest(token=token):
+                self.assertEqual(ct.PUNCTUATION_MAP.get(text[start:end], text[start:end]), token)
+
     def test_search(self):
         testcases = [
             ("nyi hau", "你好"),
@@ -46,5 +70,483 @@ class TestConvertToChinese(unittest.TestCase):
                 result = self.searcher.search(pinyins)
                 self.assertEqual(ct.format_result(result), expected_result)
 
+    def test_profile(self):
+        with profiling.profile() as profiler:
+            pinyins = ct.split_pinyin_and_punct("nyi hau, Lucy!")
+            self.searcher.search(pinyins)
+        report = profiler.report()
+        for stage in ["tokenize", "dag", "route", "decode"]:
+            with self.subTest(stage=stage):
+                self.assertEqual(report["stages"][stage]["calls"], 1)
+        self.assertIn("cache", report["hit_rates"])
+        self.assertIsNone(report["peak_memory"])
+        self.assertIsNone(profiling.active)
+
+    def test_profile_nested_stages(self):
+        with profiling.profile() as profiler:
+            with profiling.stage("search"):
+                with profiling.stage("deep_search"):
+                    with profiling.stage("search"):
+                        sum(range(10000))
+        report = profiler.report()
+        stages = report["stages"]
+        self.assertEqual(stages["search"]["calls"], 2)
+        self.assertLessEqual(sum(stage["seconds"] for stage in stages.values()), report["elapsed"])
+        self.assertLessEqual(stages["search"]["inclusive"], report["elapsed"])
+        self.assertLessEqual(stages["deep_search"]["inclusive"], stages["search"]["inclusive"])
+
+    def test_metrics(self):
+        metrics = DecoderMetrics()
+        db = ct.DB("txt/dict.db", metrics=metrics)
+        searcher = ct.DAGViterbiSearcher(db)
+        for pinyin_str in ["nyi hau", "nyi hau"]:
+            searcher.search(ct.split_pinyin_and_punct(pinyin_str))
+        db.close()
+        text = metrics.registry.render()
+        self.assertIn("pinvin_lines_decoded_total 2", text)
+        self.assertIn("pinvin_tokens_decoded_total 4", text)
+        self.assertIn("# TYPE pinvin_sql_latency_seconds histogram", text)
+        self.assertGreater(metrics.word_freq_hits.value, 0)
+
+    def test_shared_dict(self):
+        from multiprocessing import Pool
+        from flat_dict import SharedFlatDict
+        lines = ["nyi hau", "uoo heen hau", "nyihau John Smith", "xieh xieh, Lucy!"]
+        expected = [ct.decode_line(line, self.searcher) for line in lines]
+        shared = SharedFlatDict.create(self.db)
+        try:
+            self.assertEqual(ct.decode_line("nyi hau", ct.DAGViterbiSearcher(shared)), expected[0])
+            with Pool(2, initializer=ct.set_worker_dict, initargs=(shared.name,)) as pool:
+                self.assertEqual(pool.map(ct.decode_worker_line, lines), expected)
+        finally:
+            shared.close()
+
+    def test_mmap_dict(self):
+        import flat_dict
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dict.flat")
+            flat_dict.compile_flat_dict(path, db_path="txt/dict.db")
+            db = ct.open_dict(path, backend="mmap")
+            try:
+                for pinyin in ["hau", "shi", "nyihau", "xxxx"]:
+                    with self.subTest(pinyin=pinyin):
+                        expected = self.db.get_word_freq(pinyin)
+                        self.assertEqual(db.get_word_freq(pinyin), expected)
+                        self.assertEqual(db.get_best(pinyin), self.db.get_best(pinyin))
+                self.assertIn("hau", list(db.iter_prefix("ha")))
+                searcher = ct.DAGViterbiSearcher(db)
+                for line in ["nyi hau", "nyihau John Smith"]:
+                    with self.subTest(line=line):
+                        self.assertEqual(ct.decode_line(line, searcher), ct.decode_line(line, self.searcher))
+            finally:
+                db.close()
+
+    def test_migrate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dict.db")
+            db = ct.DB(path)
+            db.cursor.execute("DROP TABLE dict")
+            db.cursor.execute("DROP TABLE best")
+            db.cursor.execute("CREATE TABLE dict (pinyin TEXT NOT NULL, word TEXT NOT NULL, freq INTEGER DEFAULT 0, PRIMARY KEY (pinyin, word))")
+            db.cursor.execute("DELETE FROM meta")
+            db.conn.commit()
+            db.close()
+            db = ct.DB(path)
+            self.assertEqual(db.schema_version, 1)
+            db.import_entries([("nyihau", "你好", 10), ("nyi", "你", 5), ("nyi", "妳", 5), ("hau", "好", 7)])
+            legacy = {pinyin: db.get_best(pinyin) for pinyin in ["nyihau", "nyi", "hau", "xxxx"]}
+            self.assertTrue(db.migrate())
+            self.assertFalse(db.migrate())
+            db.close()
+            db = ct.DB(path)
+            self.assertEqual(db.schema_version, ct.SCHEMA_VERSION)
+            for pinyin, best in legacy.items():
+                with self.subTest(pinyin=pinyin):
+                    self.assertEqual(db.get_best(pinyin), best)
+            self.assertEqual(db.get_best("nyi")[:2], ("你", 5))
+            self.assertAlmostEqual(db.get_best("hau")[2], math.log(8 / db.get_total_freq()))
+            db.prefetch_word_freq(["nyi", "hau", "nyi"])
+            self.assertEqual(db.get_word_freq("nyi"), [("你", 5), ("妳", 5)])
+            db.close()
+
+    def test_search_many(self):
+        from concurrent.futures import ThreadPoolExecutor
+        lines = ["nyi hau", "uoo heen hau", "xieh xieh, Lucy!", "nyihau John Smith", "nyi hau"] * 20
+        expected = [ct.decode_line(line, self.searcher) for line in lines]
+        db = ct.ThreadSafeDB("txt/dict.db", pool_size=2)
+        try:
+            searcher = ct.DAGViterbiSearcher(db, result_cache=ct.ResultCache(capacity=2))
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertEqual(searcher.search_many(lines, executor=executor, batch_size=1), expected)
+            self.assertEqual(searcher.search_many(lines), expected)
+            self.assertEqual(db.get_best("hau"), self.db.get_best("hau"))
+            self.assertGreater(len(db.pinyin_to_best), 0)
+            self.assertEqual(db.connections.qsize(), 2)
+        finally:
+            db.close()
+
+    def test_overlays(self):
+        import flat_dict
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, name) for name in ["base.db", "domain.db", "user.db"]]
+            layers = [[("nyi", "你", 5), ("nyi", "妳", 3), ("hau", "好", 7), ("nyihau", "你好", 10)],
+                      [("nyi", "妳", 4), ("nyi", "尼", 1)],
+                      [("nyi", "尼", 2), ("ay", "愛", 0)]]
+            for path, entries in zip(paths, layers):
+                layer = ct.DB(path)
+                layer.import_entries(entries)
+                layer.close()
+            db = ct.DB(paths[0], overlays=[(paths[1], 2), (paths[2], 1)])
+            # the last overlay wins, with the frequencies of an overlay multiplied by its boost
+            merged = {("nyi", "你"): 5, ("nyi", "妳"): 8, ("nyi", "尼"): 2, ("hau", "好"): 7, ("nyihau", "你好"): 10, ("ay", "愛"): 0}
+            self.assertEqual(db.get_total_freq(), sum(freq + 1 for freq in merged.values()))
+            self.assertEqual(db.get_word_freq("nyi"), [("妳", 8), ("你", 5), ("尼", 2)])
+            self.assertEqual(db.get_best("nyi")[:2], ("妳", 8))
+            self.assertEqual(db.get_best("ay")[:2], ("愛", 0))
+            self.assertIsNone(db.get_best("xxxx"))
+            fresh = ct.DB(paths[0], overlays=[(paths[1], 2), (paths[2], 1)])
+            fresh.prefetch_word_freq(["nyi", "hau", "ay", "xxxx"])
+            self.assertEqual(fresh.pinyin_to_words["nyi"], db.get_word_freq("nyi"))
+            self.assertEqual(list(fresh.iter_entries()), sorted(((py, word, freq) for (py, word), freq in merged.items()),
+                                                                key=lambda entry: (entry[0], -entry[2], entry[1])))
+            flat = flat_dict.FlatDict(flat_dict.build_flat_dict_from_db(fresh))
+            self.assertEqual(flat.get_best("nyi"), db.get_best("nyi"))
+            flat.close()
+            searcher = ct.DAGViterbiSearcher(db)
+            self.assertEqual(ct.decode_line("nyi ay", searcher), "妳愛")
+            version = db.get_dict_version()
+            db.detach_overlay(db.overlays[0][0])
+            self.assertEqual(db.get_word_freq("nyi"), [("你", 5), ("妳", 3), ("尼", 2)])
+            self.assertNotEqual(db.get_dict_version(), version)
+            db.detach_overlay(db.overlays[0][0])
+            self.assertEqual(db.get_total_freq(), 4 * 1 + 5 + 3 + 7 + 10)
+            self.assertEqual(db.get_best("nyi"), ("你", 5, math.log(6 / db.get_total_freq())))
+            db.close()
+            fresh.close()
+
+    def test_search_budget(self):
+        db = ct.DB(":memory:")
+        db.import_entries([("nyihau", "你好", 10), ("nyi", "你", 5), ("hau", "好", 5), ("xi", "西", 1), ("an", "安", 1),
+                           ("xian", "先", 3), ("xianzay", "現在", 9), ("zay", "在", 4)])
+        metrics = DecoderMetrics()
+        searcher = ct.DAGViterbiSearcher(db, metrics=metrics)
+        tokens = ct.split_pinyin_and_punct("nyi hau, xi an zay")
+        testcases = [
+            (ct.Budget(), ["你好", "，", "現在"], "viterbi"),
+            (ct.Budget(work=100), ["你好", "，", "現在"], "viterbi"),
+            # the lattice is built for the first two positions only
+            (ct.Budget(work=6), ["你好", "，", "xi", "an", "zay"], "greedy"),
+            (ct.Budget(work=0), tokens, "passthrough"),
+            (ct.Budget(seconds=0), tokens, "passthrough"),
+        ]
+        for budget, expected, tier in testcases:
+            with self.subTest(work=budget.work, tier=tier):
+                self.assertEqual(searcher.search(list(tokens), budget=budget), expected)
+                self.assertEqual(budget.tier, tier)
+        self.assertEqual(metrics.tiers["passthrough"].value, 2)
+        # the degraded results are not cached
+        cache = ct.ResultCache()
+        searcher = ct.DAGViterbiSearcher(db, result_cache=cache, budget_work=6)
+        self.assertEqual(searcher.search(list(tokens)), ["你好", "，", "xi", "an", "zay"])
+        self.assertEqual(len(cache.entries), 0)
+        # a deep search skipped or cut short by the budget degrades the result, which is not cached
+        searcher = ct.DAGViterbiSearcher(db, result_cache=cache)
+        for work in [1, 2, 3, 8]:
+            with self.subTest(deep_search_work=work):
+                budget = ct.Budget(work=work)
+                self.assertEqual(searcher.search(["nyihaunyihauxian"], budget=budget), ["nyihaunyihauxian"])
+                self.assertEqual(budget.tier, "greedy")
+                self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(searcher.search(["nyihaunyihauxian"]), ["你好", "你好", "先"])
+        db.close()
+
+    def test_cache_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = ct.DB(os.path.join(tmpdir, "dict.db"))
+            db.import_entries([("nyihau", "你好", 10), ("nyi", "你", 5), ("hau", "好", 5)])
+            db.track_access()
+            for pinyin in ["nyi", "nyi", "hau", "nyi", "hau", "xxxx"]:
+                db.get_best(pinyin)
+            path = os.path.join(tmpdir, "cache.snapshot")
+            self.assertEqual(db.dump_cache_snapshot(path, top_n=2), 2)
+            db.close()
+            db = ct.DB(os.path.join(tmpdir, "dict.db"))
+            db.track_access()
+            self.assertEqual(db.load_cache_snapshot(path), 2)
+            self.assertEqual(set(db.pinyin_to_best), {"nyi", "hau"})
+            self.assertEqual(db.access_counts["nyi"], 3)
+            with profiling.profile() as profiler:
+                self.assertEqual(db.get_best("nyi")[:2], ("你", 5))
+            self.assertNotIn("sql.queries", profiler.counters)
+            # a snapshot of another version of the dictionary is ignored
+            db.import_entries([("ay", "愛", 3)])
+            db.pinyin_to_best.clear()
+            self.assertEqual(db.load_cache_snapshot(path), 0)
+            self.assertEqual(db.load_cache_snapshot(os.path.join(tmpdir, "missing")), 0)
+            db.close()
+
+    def test_search_batch(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        # a tie of the two paths of the first line is broken towards the longer word, as by calc_route
+        lattices = [(2, [(0, 1, -1.0), (0, 2, -2.0), (1, 2, -1.0)]), (0, []), (1, [(0, 1, -0.5)])]
+        self.assertEqual(ct.calc_batch_routes(lattices), [[(-2.0, 2), (-1.0, 2), (0, 0)], [(0, 0)], [(-0.5, 1), (0, 0)]])
+        lines = ["nyi hau", "uoo heen hau", "xieh xieh, Lucy!", "nyihau John Smith", "uoo zay jiam, Lucy!", "", "nyi hau"]
+        pinyin_lists = [ct.split_pinyin_and_punct(line) for line in lines]
+        expected = [self.searcher.search(list(pinyin_list)) for pinyin_list in pinyin_lists]
+        cache = ct.ResultCache()
+        searcher = ct.DAGViterbiSearcher(self.db, result_cache=cache)
+        for batch_size in (1, 2, 256):
+            with self.subTest(batch_size=batch_size):
+                self.assertEqual(searcher.search_batch(pinyin_lists, batch_size=batch_size), expected)
+        self.assertEqual(len(cache.entries), len(set(map(tuple, pinyin_lists))))
+        self.assertEqual(ct.decode_batch(lines, searcher, vectorized=True), [ct.decode_line(line, self.searcher) for line in lines])
+        # with a budget every line is searched on its own
+        searcher = ct.DAGViterbiSearcher(self.db, budget_work=0)
+        self.assertEqual(searcher.search_batch(pinyin_lists[:1]), [["nyi", "hau"]])
+
+    def test_result_cache(self):
+        cache = ct.ResultCache(capacity=2)
+        searcher = ct.DAGViterbiSearcher(self.db, result_cache=cache)
+        lines = ["nyi hau", "uoo heen hau", "nyi hau", "xieh xieh, Lucy!"]
+        self.assertEqual(ct.decode_batch(lines, searcher), [ct.decode_line(line, self.searcher) for line in lines])
+        self.assertEqual(list(cache.entries), [("uoo", "heen", "hau"), ("xieh", "xieh", "，", "Lucy", "！")])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "results.db")
+            cache = ct.ResultCache(capacity=0, path=path, version="1")
+            cache.put(("nyi", "hau"), ["你好"])
+            cache.close()
+            cache = ct.ResultCache(capacity=0, path=path, version="1")
+            self.assertEqual(cache.get(("nyi", "hau")), ("你好",))
+            cache.close()
+            cache = ct.ResultCache(capacity=0, path=path, version="2")
+            self.assertIsNone(cache.get(("nyi", "hau")))
+            cache.close()
+
+    def test_decoding_session(self):
+        db = ct.DB(":memory:")
+        db.import_entries([("nyihau", "你好", 10), ("nyi", "你", 5), ("hau", "好", 5), ("xi", "西", 1),
+                           ("an", "安", 1), ("xian", "先", 3), ("xianhau", "先好", 1), ("hauhau", "好好", 2)])
+        searcher = ct.DAGViterbiSearcher(db)
+        session = ct.DecodingSession(searcher)
+        pinyin_list = ["nyi", "hau", "xi", "an", "hau", "hau", "，", "Lucy", "nyi"]
+        for k, token in enumerate(pinyin_list, 1):
+            session.append(token)
+            with self.subTest(pinyins=pinyin_list[:k]):
+                self.assertEqual(session.current_best(), searcher.search(pinyin_list[:k]))
+        session.backspace()
+        session.backspace()
+        self.assertEqual(session.current_best(), searcher.search(pinyin_list[:-2]))
+        db.close()
+        # aa has no single pinyin edge, since the word aaba starts there, so the search
+        # does not take the more frequent babc
+        db = ct.DB(":memory:")
+        db.import_entries([("aaba", "甲", 1), ("babc", "乙", 50)])
+        searcher = ct.DAGViterbiSearcher(db)
+        session = ct.DecodingSession(searcher)
+        pinyin_list = ["aa", "ba", "bc", "aa"]
+        for k, token in enumerate(pinyin_list, 1):
+            session.append(token)
+            with self.subTest(pinyins=pinyin_list[:k]):
+                self.assertEqual(session.current_best(), searcher.search(pinyin_list[:k]))
+        self.assertEqual(searcher.search(pinyin_list[:3]), ["甲", "bc"])
+        for k in range(len(pinyin_list) - 1, -1, -1):
+            session.backspace()
+            with self.subTest(backspace=pinyin_list[:k]):
+                self.assertEqual(session.current_best(), searcher.search(pinyin_list[:k]))
+        db.close()
+
+    def test_import_tables(self):
+        db = ct.DB(":memory:")
+        count = db.import_tables(["pinvin_trad.dict.yaml"])
+        self.assertGreater(count, 0)
+        self.assertGreater(db.get_total_freq(), count)
+        self.assertIn("好", [word for word, freq in db.get_word_freq("hau")])
+        db.close()
+
+class TestTableTools(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_file(self, name, text):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_count_phrases(self):
+        text = "一乾二淨，乾淨的一乾二淨。" * 50
+        path = self.write_file("corpus.txt", text)
+        matcher = count_phrases.PhraseMatcher(["一乾二淨", "乾淨", "二淨"])
+        expected = {phrase: text.count(phrase) for phrase in ["一乾二淨", "乾淨", "二淨"]}
+        for chunk_size in [7, 64, 1 << 20]:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(dict(count_phrases.count_file(matcher, path, chunk_size=chunk_size)), expected)
+        self.assertEqual(count_phrases.split_count(12, 2), [6, 6])
+        self.assertEqual(count_phrases.split_count(5, 3), [2, 2, 1])
+        # 喬治．布希 has a character missing from the code tables, so it has no code
+        out = io.StringIO()
+        with redirect_stderr(io.StringIO()) as err:
+            count_phrases.write_frequency({"喬治．布希": 3, "你好": 4}, out)
+        self.assertEqual(out.getvalue(), "你好\tni hao\t4\n")
+        self.assertIn("喬治．布希", err.getvalue())
+
+    def test_validation_report(self):
+        phrases = self.write_file("phrases.txt", "你好: nǐ hǎo\n你好: xyz hǎo\n")
+        words = self.write_file("words.txt", "你好\n你\U000F0000\n")
+        table = self.write_file("table.dict.yaml", "---\n...\n你好\tnyi hau\t1\n你好\tnyi xyz\t1\n")
+        report = cp.build_validation_report(phrase_file=phrases, word_files=[words], tables=[table])
+        self.assertEqual(report["sources"][phrases]["inconsistent"], {"你好": [["xyz", "hǎo"]]})
+        self.assertEqual(report["sources"][words]["missing_chars"], {"\U000F0000": ["你\U000F0000"]})
+        self.assertEqual(report["sources"][table]["inconsistent"], {"你好": ["nyi xyz"]})
+        self.assertEqual(report["inconsistent_chars"], cp.get_chars_of_inconsistent_phrases(
+            report["sources"][phrases]["inconsistent_loose"]))
+
+    def test_syllable_ids(self):
+        ids = cp.kSyllables.intern_seq(["nǐ", "ǎi"])
+        self.assertEqual(cp.kSyllables.decode(ids), ["nǐ", "ǎi"])
+        self.assertEqual(cp.kSyllables.get_toneless(ids), " ".join(cp.get_toneless_pinyin_seq(["nǐ", "ǎi"])))
+        self.assertEqual(cp.kSyllables.get_pinvin_seq(ids), cp.get_pinvin_seq(["nǐ", "ǎi"]))
+        codes = cp.get_pinyin_code_of_chars(reviseDe = True)
+        interned = cp.get_interned_code_of_chars(reviseDe = True)
+        self.assertEqual(list(interned), list(codes))
+        for char in ["的", "地", "好"]:
+            with self.subTest(char=char):
+                self.assertEqual(cp.kSyllables.decode(interned[char]), codes[char])
+
+    def test_frequency_store(self):
+        path = self.write_file("freq.txt", "你好\tni hao\t3\n你好\tni hao\t2\n好\thao\t7\n")
+        cache_dir = os.path.join(self.tmpdir.name, "cache")
+        store = cp.load_frequency_store(path, cache_dir)
+        self.assertEqual(store.lookup_many(["你好\tni hao", "好\thao", "好\thau"]), [5, 7, 0])
+        self.assertEqual(cp.load_frequency_store(path, cache_dir).freqs, store.freqs)
+        # an unreadable artifact is rebuilt
+        self.write_file(os.path.join("cache", "freq.txt.freq"), "garbage")
+        self.assertEqual(cp.load_frequency_store(path, cache_dir).get("好", "hao"), 7)
+
+    def test_dedup_index(self):
+        path = os.path.join(self.tmpdir.name, "dedup.db")
+        order = ["primary", "ext", "extA"]
+        store = cp.FrequencyStore({}, None)
+        phrases = {"你好": [["nǐ", "hǎo"]], "愛": [["ài"]]}
+        def generate(table, word_codes):
+            out = io.StringIO()
+            dedup = cp.DedupIndex(path, table, order)
+            with redirect_stderr(io.StringIO()):
+                cp.print_word_codes(cp.kSyllables.intern_phrases(word_codes), store, outfile=out, dedup=dedup)
+                dedup.close()
+            return [line.split("\t")[:2] for line in out.getvalue().splitlines()]
+        ext = generate("ext", phrases)
+        self.assertEqual(ext, [["愛", "ay"], ["愛", "vay"], ["你好", "nyi hau"]])
+        # a row of a table of higher priority is kept by that table only
+        self.assertEqual(generate("extA", {"你好": [["nǐ", "hǎo"]], "好": [["hǎo"]]}), [["好", "hau"]])
+        # regenerating a table releases its rows first
+        self.assertEqual(generate("ext", phrases), ext)
+        self.assertEqual(cp.get_duplicates(path), [("extA", "你好", "nyi hau", "ext")])
+        # a table of higher priority generated later takes the row
+        self.assertEqual(generate("primary", {"好": [["hǎo"]]}), [["好", "hau"]])
+        self.assertEqual(generate("extA", {"好": [["hǎo"]]}), [])
+
+    def test_parallel_codes(self):
+        words = ["你好", "愛", "好", "你好", "安安", "的"]
+        store = cp.FrequencyStore({"你好\tni hao": 5, "好\thao": 7, "安安\tan an": 2})
+        outputs = []
+        for jobs in [1, 2]:
+            out = io.StringIO()
+            cp.print_code_of_words(words, store, outfile=out, jobs=jobs, chunk_size=2)
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertIn("你好\tnyi hau\t5\n", outputs[0])
+        self.assertEqual(outputs[0].count("你好\tnyi hau\t"), 1)
+
+    def get_lexicon(self):
+        lex = lexicon.Lexicon()
+        lex.readings = {"你好": "nyi hau", "你": "nyi", "好": "hau", "愛": "ay"}
+        lex.freqs = {"你好": 10, "你": 5, "好": 5, "愛": 3}
+        lex.update_total()
+        return lex
+
+    def test_lexicon_file(self):
+        path = os.path.join(self.tmpdir.name, "lexicon.pickle")
+        self.get_lexicon().save(path)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["lexicon.pickle"])
+        self.assertEqual(lexicon.Lexicon.load(path).readings, self.get_lexicon().readings)
+        # a truncated or missing file is rebuilt instead of failing
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertIsNone(lexicon.Lexicon.load(path))
+        self.assertIsNone(lexicon.Lexicon.load(os.path.join(self.tmpdir.name, "missing")))
+
+    def test_round_trip(self):
+        import evaluate
+        self.assertEqual(evaluate.get_edit_distance("你好嗎", "妳好"), 2)
+        lex = self.get_lexicon()
+        lex.readings["妳"] = "nyi"
+        lex.add_word("妳", 1)
+        db = ct.DB(":memory:")
+        db.import_entries([("nyihau", "你好", 10), ("nyi", "你", 5), ("hau", "好", 5), ("ay", "愛", 3)])
+        round_trip = evaluate.RoundTrip(lexicon.PinvinAnnotator(lex), lexicon.Segmenter(lex), ct.DAGViterbiSearcher(db))
+        self.assertEqual(round_trip.evaluate_line("你好！"), ("你好！", "Nyihau!", "你好！", 2, 0))
+        path = self.write_file("corpus.txt", "你好！\n\n愛你\n妳好\n妳愛妳\n")
+        report = evaluate.evaluate(evaluate.get_corpus_chunks([path], 2), round_trip, worst=1)
+        result = report.to_dict(1.0)
+        self.assertEqual((result["lines"], result["chars"], result["char_errors"]), (4, 9, 3))
+        self.assertAlmostEqual(result["char_accuracy"], 1 - 3 / 9, places=6)
+        self.assertEqual(result["sentence_accuracy"], 0.5)
+        self.assertEqual([item["line"] for item in result["worst"]], ["妳愛妳"])
+        self.assertEqual(set(result["stages"]), {"encode", "decode"})
+        db.close()
+
+    def test_annotator(self):
+        annotator = lexicon.PinvinAnnotator(self.get_lexicon())
+        testcases = [
+            ("你好", ["nyi", "hau"]),
+            ("你愛", ["nyi", "vay"]),
+            ("好AB1", ["hau", "AB1"]),
+            ("愛", ["ay"]),
+        ]
+        for word, expected_result in testcases:
+            with self.subTest(word=word):
+                self.assertEqual(annotator.annotate(word), expected_result)
+
+    def test_segmenter(self):
+        segmenter = lexicon.Segmenter(self.get_lexicon())
+        self.assertEqual(segmenter.lcut("你好愛你 ABC123好"), ["你好", "愛", "你", " ", "ABC123", "好"])
+        path = self.write_file("userdict.txt", "愛你 100\n")
+        segmenter.load_userdict(path)
+        self.assertEqual(segmenter.lcut("你好愛你"), ["你好", "愛你"])
+
+    def test_filter_userdb_streaming(self):
+        lines = ["# Rime user dictionary", "#@/db_name\tpinvin.userdb"]
+        lines += ["%s \t詞%d\tc=1" % (" ".join(["nyi"] * (i % 5 + 1)), i) for i in range(200)]
+        path = self.write_file("pinvin.userdb.txt", "\n".join(lines) + "\n")
+        for maxlength in [None, 3]:
+            expected = io.StringIO()
+            with redirect_stdout(expected):
+                filter_userdb.filter_file(path, maxlength=maxlength)
+            for jobs in [1, 3]:
+                with self.subTest(maxlength=maxlength, jobs=jobs):
+                    result = io.StringIO()
+                    filter_userdb.filter_file_streaming(path, maxlength=maxlength, jobs=jobs, outfile=result)
+                    self.assertEqual(result.getvalue(), expected.getvalue())
+
+    def test_filter_words_pipeline(self):
+        lines = ["一一七中學", "得: de", "大地: da di", "  一一七中學  ", "好", "你好嗎們"] * 30
+        path = self.write_file("words.txt", "\n".join(lines) + "\n")
+        pipeline = filter_words.Pipeline(normalize=True, min_length=2, max_length=4, filter_dedider=True, dedupe=True)
+        serial = io.StringIO()
+        pipeline.run(path, outfile=serial)
+        self.assertEqual(serial.getvalue(), "大地: da di\n你好嗎們\n")
+        parallel = io.StringIO()
+        pipeline.run(path, jobs=2, chunk_size=7, outfile=parallel)
+        self.assertEqual(parallel.getvalue(), serial.getvalue())
+
 if __name__ == '__main__':
     unittest.main()